@@ -18,15 +18,23 @@
 # along with darbup.  If not, see <http://www.gnu.org/licenses/>.
 
 import config
-from archive import ArchiveSet
-from procwrite import proc_write
+from archive import ArchiveSet, KINDS
+from arcindex import ArchiveIndex
+from state import SectionState
+from locks import section_lock
+from throttle import Throttle
+import libc
 from cleaner import make_cleaner
+from metrics import RunMetrics
+from progress import Progress, read_status, format_size
+import spans
 from errors import BackupError, NoRemovalCandidatesError, TerminatedSignal
 from errors import exc_str
 
 import sys, datetime, os, os.path, pwd, signal
 import argparse, logging
 from logging.handlers import RotatingFileHandler
+from contextlib import contextmanager
 
 
 def main():
@@ -38,6 +46,8 @@ def main():
     if euid == 0:  # I am root
         default_config = '/etc/darbup.conf'
         lock_filename = '/run/darbup.lock'
+        lock_dir = '/run/darbup'
+        state_dir = '/var/lib/darbup'
     else:
         if not pw.pw_dir:
             sys.stderr.write('error: user {} has no home directory'.format(
@@ -46,6 +56,8 @@ def main():
         darbup_dir = os.path.join(pw.pw_dir, '.darbup')
         default_config = os.path.join(darbup_dir, 'config')
         lock_filename = os.path.join(darbup_dir, 'lock')
+        lock_dir = os.path.join(darbup_dir, 'locks')
+        state_dir = os.path.join(darbup_dir, 'state')
         try:
             os.mkdir(darbup_dir)
         except FileExistsError:
@@ -55,6 +67,9 @@ def main():
     parser.add_argument('--full', action='store_true', help='do full backup')
     parser.add_argument('--incr', action='store_true',
                         help='do incremental backup')
+    parser.add_argument('--diff', action='store_true',
+                        help='do differential backup (relative to the latest '
+                        'full backup)')
     parser.add_argument('-c', '--config', metavar='FILENAME',
                         help='configuration file to use (default: {})' \
                         .format(default_config), default=default_config)
@@ -62,12 +77,95 @@ def main():
                         help='logging level (default: INFO)',
                         choices=('DEBUG','INFO','WARNING','ERROR','CRITICAL'),
                         default='INFO')
+    parser.add_argument('-p', '--parallel', action='store_true',
+                        help='back up sections whose destination directories '
+                        'are on different disks concurrently')
+    parser.add_argument('-d', '--daemon', action='store_true',
+                        help='keep running, backing up each section when it '
+                        'is next due; reload the configuration on SIGHUP')
+    parser.add_argument('-i', '--interval', metavar='SECONDS', type=int,
+                        help='in daemon mode, minimum time between attempts '
+                        'to back up the same section (default: 3600)',
+                        default=3600)
+    parser.add_argument('-s', '--section', metavar='NAME', action='append',
+                        dest='sections',
+                        help='only back up the section "Backup NAME" (may be '
+                        'given more than once; default: all sections)')
+    parser.add_argument('-w', '--wait', action='store_true',
+                        help='if a section is being backed up by another '
+                        'instance, wait for it to finish, rather than '
+                        'skipping the section')
+    parser.add_argument('--trace', action='store_true',
+                        help='time the phases of the run, and print a '
+                        'summary of them to standard error at the end')
+    parser.add_argument('--profile', metavar='FILENAME',
+                        help='profile the run using cProfile, and save the '
+                        'statistics (in pstats format) to FILENAME')
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    restore_parser = commands.add_parser(
+        'restore', help='restore files from the archives of a section')
+    restore_parser.add_argument('path', metavar='PATH',
+                                help='file or directory to restore: relative '
+                                'to the root of the archives (as given to dar '
+                                'by its -R option), or absolute beneath it')
+    restore_parser.add_argument('--at', metavar='TIME', type=parse_time,
+                                help='restore PATH as it was at TIME, given as '
+                                '"YYYY-MM-DD HH:MM" or "YYYY-MM-DD" (meaning '
+                                'the end of that day); default: now')
+    restore_parser.add_argument('--into', metavar='DIR', default='.',
+                                help='directory to restore into (default: the '
+                                'current directory)')
+    commands.add_parser('status', help='show the progress of any backups '
+                        'being made, and when each section is next due')
+    commands.add_parser('stats', help='report on past runs of each section, '
+                        'from the history kept under the state directory')
     args = parser.parse_args()
-    if args.full and args.incr:
+    forced_kinds = [ kind for kind in KINDS if getattr(args, kind) ]
+    if len(forced_kinds) > 1:
         sys.stderr.write(parser.format_usage())
-        sys.stderr.write('error: only one of --full, --incr may be given\n')
+        sys.stderr.write('error: only one of --full, --incr, --diff may be '
+                         'given\n')
+        return 2
+    args.force_kind = forced_kinds[0] if forced_kinds else None
+    if args.daemon and args.force_kind:
+        sys.stderr.write(parser.format_usage())
+        sys.stderr.write('error: --full, --incr and --diff cannot be used '
+                         'with --daemon\n')
+        return 2
+    if args.command and (args.force_kind or args.daemon or args.parallel):
+        sys.stderr.write(parser.format_usage())
+        sys.stderr.write('error: --full, --incr, --diff, --daemon and '
+                         '--parallel cannot be used with a command\n')
+        return 2
+    if args.interval < 60:
+        # archive names only have minute resolution
+        sys.stderr.write(parser.format_usage())
+        sys.stderr.write('error: --interval must be at least 60\n')
         return 2
 
+    if args.trace:
+        spans.enable()
+    profiler = None
+    if args.profile:
+        import cProfile  # only needed here
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        if not args.daemon:
+            # Sections are locked individually, so that e.g. a manual backup
+            # of one section can run while another one is being backed up.
+            return darbup(args, default_config, state_dir, lock_dir)
+        return run_locked(args, pw, lock_filename, default_config, state_dir,
+                          lock_dir)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        spans.report(sys.stderr)
+
+
+def run_locked(args, pw, lock_filename, default_config, state_dir, lock_dir):
+    # Runs darbup() while holding the global lock.
     have_lock = False
 
     try:
@@ -77,7 +175,7 @@ def main():
                 os.lockf(lock_file.fileno(), os.F_TLOCK, 0)
             except BlockingIOError:
                 other_pid = lock_file.read().rstrip()
-                sys.stderr.write('Another instance of darbup is already '
+                sys.stderr.write('Another darbup daemon is already '
                                  'running as PID {} for user {}\n'
                                  .format(other_pid, pw.pw_name))
                 return 1
@@ -87,18 +185,21 @@ def main():
             lock_file.write('{}\n'.format(os.getpid()))
             lock_file.flush()
 
-            darbup(args, default_config)
+            return darbup(args, default_config, state_dir, lock_dir)
     finally:
         if have_lock:
             os.remove(lock_filename)
 
 
-def darbup(args, default_config):
+def darbup(args, default_config, state_dir, lock_dir):
     logger = logging.getLogger()
     logger.setLevel(args.loglevel)
 
     errlogHandler = logging.StreamHandler(sys.stderr)
-    errlogHandler.setLevel(logging.ERROR)
+    # a daemon's standard error usually goes to the system log; commands are
+    # run interactively
+    errlogHandler.setLevel(args.loglevel if args.daemon or args.command
+                           else logging.ERROR)
     logger.addHandler(errlogHandler)
 
     if not os.path.exists(args.config) and args.config == default_config:
@@ -106,65 +207,417 @@ def darbup(args, default_config):
         return 1
 
     try:
-        conf = config.Config(args.config)
+        with spans.span('read configuration'):
+            conf = config.Config(args.config, state_dir, lock_dir)
+        instances = selected_instances(conf, args)
     except Exception as e:
         sys.stderr.write('Failed to read configuration: {}\n'
                          .format(exc_str(e)))
         return 1
 
-    for cfg in conf.instances:
-        os.makedirs(os.path.dirname(cfg.logfilename), exist_ok=True)
-        log_handler = LogFileHandler(cfg.logfilename,
-                                     backupCount=cfg.logsbackupcount)
-        logger.addHandler(log_handler)
-        log_formatter = logging.Formatter(
-            '{asctime} {levelname[0]}{levelname[0]} {message}', style='{')
-        log_handler.setFormatter(log_formatter)
+    if args.command == 'restore':
+        return run_restore(instances, args)
+    if args.command == 'stats':
+        return run_stats(instances)
+    if args.command == 'status':
+        return run_status(instances)
+    if args.daemon:
+        return run_daemon(instances, args, state_dir, lock_dir)
+    if args.parallel:
+        return run_parallel(instances, args)
+    return _run_group(instances, args)
+
+
+def parse_time(s):
+    try:
+        return datetime.datetime.strptime(s, '%Y-%m-%d %H:%M')
+    except ValueError:
+        pass
+    try:
+        day = datetime.datetime.strptime(s, '%Y-%m-%d')
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid time: "{}"'.format(s))
+    return day + datetime.timedelta(days=1, minutes=-1)
+
+
+def selected_instances(conf, args):
+    if not args.sections:
+        return conf.instances
+    names = set(cfg.name for cfg in conf.instances)
+    for name in args.sections:
+        if name not in names:
+            raise BackupError('No such section: "Backup {}"'.format(name))
+    return [ cfg for cfg in conf.instances if cfg.name in args.sections ]
+
+
+def run_restore(instances, args):
+    if len(instances) != 1:
+        logging.error('Use --section to choose the section to restore from')
+        return 1
+    cfg = instances[0]
+    import restore  # only needed here
+    from catalogs import CatalogCache  # only needed here
+    try:
+        with section_lock(cfg, args.wait):
+            restore.restore(cfg, open_arcset(cfg.name, cfg.dest_dir),
+                            CatalogCache(cfg) if cfg.catalog_cache else None,
+                            restore.archive_path(cfg, args.path),
+                            args.at or datetime.datetime.now(), args.into)
+    except (BackupError, OSError) as e:
+        logging.error(str(e))
+        return 1
+    except (KeyboardInterrupt, TerminatedSignal) as e:
+        logging.error(exc_str(e))
+        return 1
+
+
+def run_status(instances):
+    # Answers from the lock and state directories only, so no disks are
+    # woken up.
+    for cfg in instances:
+        status = read_status(cfg)
+        if not status:
+            latest_time = SectionState(cfg).latest_time()
+            if latest_time is None:
+                print('{}: idle; no backup recorded yet'.format(cfg.name))
+                continue
+            due = next_due(cfg)
+            print('{}: idle; latest backup at {:%Y-%m-%d %H:%M}, next due {}'
+                  .format(cfg.name, latest_time,
+                          'never' if due == datetime.datetime.max else
+                          'now' if due <= datetime.datetime.now() else
+                          'at {:%Y-%m-%d %H:%M}'.format(due)))
+            continue
+        kind = status['kind']
+        what = ('consolidating archives' if kind == 'consolidation' else
+                'writing {} backup'.format(TYPE_WORDS.get(kind, kind)))
+        line = '{}: {} (PID {}) to {}, since {:%H:%M}: {}'.format(
+            cfg.name, what, status['pid'], status['destination'],
+            datetime.datetime.fromtimestamp(status['start_time']),
+            format_size(status.get('bytes_written', 0)))
+        expected_size = status.get('expected_size')
+        if expected_size:
+            if status.get('bytes_written', 0) <= expected_size:
+                line += ' of about {} ({:.0f}%)'.format(
+                    format_size(expected_size),
+                    100 * status.get('bytes_written', 0) / expected_size)
+            else:
+                line += ' (more than the {} of the previous one)'.format(
+                    format_size(expected_size))
+        if status.get('rate') is not None:
+            line += ' at {}/s'.format(format_size(status['rate']))
+        if status.get('eta'):
+            eta = datetime.datetime.fromtimestamp(status['eta'])
+            line += ', done at about {:%H:%M}'.format(eta)
+        print(line)
+
+
+def run_stats(instances):
+    import history  # only needed here
+    for cfg in instances:
+        runs = history.RunHistory(cfg.state_dir)
         try:
-            run(cfg, args.full, args.incr)
-        except (BackupError, OSError) as e:
-            logging.error(str(e))
-        except (KeyboardInterrupt, TerminatedSignal) as e:
-            logging.error(exc_str(e))
-            return 1
-        except Exception as e:
-            logging.exception(e)
-            raise
+            runs.report(cfg, sys.stdout)
         finally:
-            logger.removeHandler(log_handler)
+            runs.close()
 
 
-def run(cfg, force_full, force_incr):
-    clean_parts(cfg.dest_dir)
-    now = datetime.datetime.now()
-    arcset = ArchiveSet(cfg.name, cfg.dest_dir)
-
-    if force_incr:
-        if not arcset:
-            raise BackupError('Cannot run incremental backup: no archives '
-                              'exist yet')
-        backup(True, cfg, now, arcset)
-    elif force_full or not arcset:
-        backup(False, cfg, now, arcset)
-    else:
-        latest_time = arcset.latest().timestamp
-        if cfg.full_intvl(latest_time, now):
-            backup(False, cfg, now, arcset)
-        elif cfg.incr_intvl(latest_time, now):
-            backup(True, cfg, now, arcset)
-        else:
-            logging.debug('Not time for next backup yet: ' + cfg.name)
+_MAX_SLEEP_SECS = 3600  # recheck at least this often, in case of clock changes
+
+def run_daemon(instances, args, state_dir, lock_dir):
+    # Runs until terminated (while holding the lock): backs up each section
+    # once it is due, and sleeps in between.  On SIGHUP, re-reads the
+    # configuration file, once any backups in progress have finished.  While
+    # sleeping, SIGHUP is blocked, and waited for.
+    global sighup_received
+    signal.signal(signal.SIGHUP, handle_sighup)
+    signal.pthread_sigmask(signal.SIG_BLOCK, [ signal.SIGHUP ])
+    last_attempts = { }
+    while True:
+        if sighup_received:
+            sighup_received = False
+            logging.info('Received SIGHUP: reloading configuration')
+            try:
+                instances = selected_instances(
+                    config.Config(args.config, state_dir, lock_dir), args)
+            except Exception as e:
+                logging.error('Failed to reload configuration, keeping the '
+                              'old one: {}'.format(exc_str(e)))
+
+        now = datetime.datetime.now()
+        due_times = { }
+        for cfg in instances:
+            due = next_due(cfg)
+            last_attempt = last_attempts.get(cfg.name)
+            if last_attempt is not None:
+                due = max(due, last_attempt +
+                          datetime.timedelta(seconds=args.interval))
+            due_times[cfg.name] = due
+        due_instances = [ cfg for cfg in instances
+                          if due_times[cfg.name] <= now ]
+        if due_instances:
+            for cfg in due_instances:
+                last_attempts[cfg.name] = now
+            # unblocked, so that dar does not inherit the blocked signal
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, [ signal.SIGHUP ])
+            try:
+                if args.parallel:
+                    status = run_parallel(due_instances, args)
+                else:
+                    status = _run_group(due_instances, args)
+            finally:
+                signal.pthread_sigmask(signal.SIG_BLOCK, [ signal.SIGHUP ])
+            if status:
+                return status
+            continue
+
+        wakeup = min(due_times.values(), default=None)
+        secs = (_MAX_SLEEP_SECS if wakeup is None else
+                min((wakeup - now).total_seconds(), _MAX_SLEEP_SECS))
+        logging.debug('Sleeping for {:.0f} seconds'.format(secs))
+        try:
+            if signal.sigtimedwait([ signal.SIGHUP ], secs) is not None:
+                sighup_received = True
+        except (KeyboardInterrupt, TerminatedSignal) as e:
+            logging.info('Exiting: {}'.format(exc_str(e)))
+            return 0
 
 
-def backup(is_incr, cfg, now, arcset):
-    logging.info('Existing archives: {!s}'.format(arcset))
-    type_word = 'incremental' if is_incr else 'full'
+def next_due(cfg):
+    # Returns the time at which the next backup (or consolidation) of section
+    # 'cfg' is due, going by the state recorded locally.
+    state = SectionState(cfg)
+    latest_time = state.latest_time()
+    if latest_time is None:
+        return datetime.datetime.min
+    return min(cfg.full_intvl.next_due(latest_time),
+               cfg.diff_intvl.next_due(latest_time),
+               cfg.incr_intvl.next_due(latest_time),
+               next_consolidation(cfg, state))
+
+
+def run_instance(cfg, args):
+    try:
+        with spans.span('section ' + cfg.name), \
+                section_lock(cfg, args.wait):
+            return _run_locked_instance(cfg, args)
+    except BackupError as e:
+        logging.error(str(e))
+    except (KeyboardInterrupt, TerminatedSignal) as e:
+        logging.error(exc_str(e))
+        return 1
+
+
+def _run_locked_instance(cfg, args):
+    logger = logging.getLogger()
+    os.makedirs(os.path.dirname(cfg.logfilename), exist_ok=True)
+    log_handler = LogFileHandler(cfg.logfilename,
+                                 backupCount=cfg.logsbackupcount)
+    logger.addHandler(log_handler)
+    log_formatter = logging.Formatter(
+        '{asctime} {levelname[0]}{levelname[0]} {message}', style='{')
+    log_handler.setFormatter(log_formatter)
+    try:
+        run(cfg, args.force_kind)
+    except (BackupError, OSError) as e:
+        logging.error(str(e))
+    except (KeyboardInterrupt, TerminatedSignal) as e:
+        logging.error(exc_str(e))
+        return 1
+    except Exception as e:
+        logging.exception(e)
+        raise
+    finally:
+        logger.removeHandler(log_handler)
+
+
+def run_parallel(instances, args):
+    # Sections writing to the same disk (whether to their destination
+    # directory or to a mirror) are run one after the other, by the same
+    # worker process; each group of disks gets its own worker.  Worker
+    # processes (rather than threads) give each section its own logging
+    # configuration and signal handling, exactly as in the sequential case.
+    groups = [ ]  # pairs of a set of disks, and the sections writing to them
+    for cfg in instances:
+        devices = set(device_of(path)
+                      for path in [ cfg.dest_dir ] + cfg.mirror_dirs)
+        sections = [ cfg ]
+        for group in [ g for g in groups if g[0] & devices ]:
+            groups.remove(group)
+            devices |= group[0]
+            sections.extend(group[1])
+        sections.sort(key=instances.index)
+        groups.append((devices, sections))
+    if len(groups) < 2:
+        return _run_group(instances, args)
+
+    import multiprocessing  # only needed here; slow to import
+    context = multiprocessing.get_context('fork')
+    workers = [ context.Process(target=_run_worker, args=(sections, args))
+                for devices, sections in groups ]
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    except (KeyboardInterrupt, TerminatedSignal) as e:
+        logging.error(exc_str(e))
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in workers:
+            if worker.pid is not None:
+                worker.join()
+        return 1
+    if any(worker.exitcode for worker in workers):
+        return 1
+
+
+def _run_group(instances, args):
+    for cfg in instances:
+        status = run_instance(cfg, args)
+        if status:
+            return status
+
+
+def _run_worker(instances, args):
+    if spans.enabled():
+        spans.enable()  # start afresh, and report separately
+    try:
+        status = _run_group(instances, args)
+    finally:
+        spans.report(sys.stderr, 'Trace of worker process {}'.format(
+            os.getpid()))
+    sys.exit(status)
+
+
+def device_of(path):
+    # Returns a key identifying the disk that 'path' resides on: partitions of
+    # the same block device map to the same key.  Network and FUSE filesystems
+    # have no block device, so they are keyed by their (anonymous) device
+    # number instead.
+    try:
+        dev = os.stat(path).st_dev
+    except OSError:
+        return path  # run() will report the error
+    sysfs_path = os.path.realpath('/sys/dev/block/{}:{}'.format(
+        os.major(dev), os.minor(dev)))
+    if not os.path.exists(sysfs_path):
+        return dev
+    if os.path.exists(os.path.join(sysfs_path, 'partition')):
+        sysfs_path = os.path.dirname(sysfs_path)
+    return sysfs_path
+
+
+def run(cfg, force_kind):
+    now = datetime.datetime.now()
+    with spans.span('read state'):
+        state = SectionState(cfg)
+    latest_time = state.latest_time()
+    if (not force_kind and latest_time and not due_kind(cfg, latest_time, now)
+            and next_consolidation(cfg, state) > now):
+        # Decided purely from local state, without touching the destination
+        # directory at all.
+        logging.debug('Not time for next backup yet: ' + cfg.name)
+        return
+
+    with spans.span('open archive set'):
+        arcset = open_arcset(cfg.name, cfg.dest_dir)
+    arcsets = [ arcset ]
+    for dest_dir in cfg.mirror_dirs:
+        try:
+            with spans.span('open mirror archive set'):
+                arcsets.append(open_arcset(cfg.name, dest_dir))
+        except OSError as e:
+            logging.error('Skipping mirror destination directory {}: {}'
+                          .format(dest_dir, exc_str(e)))
+
+    metrics = RunMetrics(cfg.name)
+    try:
+        with priority(cfg):
+            if force_kind and force_kind != 'full':
+                if not arcset:
+                    raise BackupError('Cannot run {} backup: no archives '
+                                      'exist yet'.format(
+                                          TYPE_WORDS[force_kind]))
+                backup(force_kind, cfg, now, arcsets, metrics)
+            elif force_kind or not arcset:
+                backup('full', cfg, now, arcsets, metrics)
+            else:
+                kind = due_kind(cfg, arcset.latest().timestamp, now)
+                if kind:
+                    backup(kind, cfg, now, arcsets, metrics)
+                elif next_consolidation(cfg, state) <= now:
+                    # recorded up front, so that failures are not retried at
+                    # once
+                    state.record_consolidation(now)
+                    consolidate(cfg, now, arcsets, metrics)
+                else:
+                    logging.debug('Not time for next backup yet: ' + cfg.name)
+    finally:
+        with spans.span('record state'):
+            state.record(arcset)
+            if metrics.kind:
+                if cfg.metrics_dir:
+                    metrics.write(cfg.metrics_dir)
+                import history  # only needed here
+                history.record(cfg, metrics, arcset.total_size())
+
+
+TYPE_WORDS = { 'full': 'full', 'incr': 'incremental', 'diff': 'differential' }
+
+def due_kind(cfg, latest_time, now):
+    # Returns the kind of backup that is due, if any, given the time of the
+    # latest one.  If several are due, the one that goes furthest back wins.
+    if cfg.full_intvl(latest_time, now):
+        return 'full'
+    if cfg.diff_intvl(latest_time, now):
+        return 'diff'
+    if cfg.incr_intvl(latest_time, now):
+        return 'incr'
+    return None
+
+
+def next_consolidation(cfg, state):
+    # Returns the time at which the next consolidation is due.
+    return cfg.consolidation_intvl.next_due(
+        state.consolidation_time() or datetime.datetime.min)
+
+
+def open_arcset(name, dest_dir):
+    if not ArchiveIndex(dest_dir).is_fresh():
+        # If the index is up to date, nothing can have been left behind by an
+        # interrupted run (as creating a partial file invalidates it; see
+        # ArchiveSet.create_temp()), so we needn't list the directory.
+        with spans.span('clean partial files'):
+            clean_parts(dest_dir)
+    with spans.span('scan archives'):
+        return ArchiveSet(name, dest_dir)
+
+
+def backup(kind, cfg, now, arcsets, metrics=None):
+    # The first archive set is the one in cfg.dest_dir; any others are
+    # mirrors, which are written the same archive.  Each is cleaned
+    # independently.
+    # only needed here (and in consolidate()); slow to import
+    from procwrite import proc_write
+    from checksum import Checksummer
+    from catalogs import CatalogCache
+    arcset = arcsets[0]
+    for a in arcsets:
+        logging.info('Existing archives: {!s}'.format(a))
+    type_word = TYPE_WORDS[kind]
     logging.info('Starting {} backup: {}'.format(type_word, cfg.name))
+    if metrics:
+        metrics.kind = kind
+    catalogs = CatalogCache(cfg) if cfg.catalog_cache else None
 
     def make_command():
         cmd = [ '/usr/bin/dar', '-c', '-' ]
-        if is_incr:
-            cmd.extend(( '-A', arcset.latest().basepath() ))
+        reference = arcset.reference_for(kind)
+        if reference:
+            cmd.extend(( '-A', catalogs.reference(reference) if catalogs
+                               else reference.basepath() ))
         cmd.extend(cfg.dar_args)
         return cmd
 
@@ -178,49 +631,302 @@ def backup(is_incr, cfg, now, arcset):
     else:
         good_exit_codes = (0,)
 
-    dest_path = arcset.append_current(now, is_incr)
+    dest_paths = [ a.append_current(now, kind) for a in arcsets ]
     # We must add the archive to the set now, so that the removal policy is
     # aware of it (i.e. if it's incremental, we must not remove the previous
     # archive)
 
-    dest_path_temp = dest_path + '.part'
-    cleaner = make_cleaner(cfg.rmpolicy, arcset, now)
+    # Mirrors contain the same archives, but the catalogs are those of the
+    # archives in cfg.dest_dir.
+    cleaners = [ make_cleaner(cfg.rmpolicy, a, now, cfg.cleaner_watermark,
+                              catalogs if a is arcset else None)
+                 for a in arcsets ]
+
+    predicted_sizes = [ None ] * len(arcsets)
+    if cfg.preclean:
+        for i, a in enumerate(arcsets):
+            predicted_size = a.predict_size(kind)
+            if predicted_size is not None:
+                predicted_size += predicted_size * cfg.preclean_margin // 100
+                with spans.span('preclean'):
+                    preclean(cfg, a, cleaners[i], predicted_size)
+            predicted_sizes[i] = predicted_size
+
+    # The destinations still being written to.  Each one's current archive
+    # must be relative to the same archive as dar's output (see drop()).
+    live = list(range(len(arcsets)))
+
+    def reference_name(a):
+        reference = a.latest().reference()
+        return reference.basename() if reference else None
+
+    def drop(i, error):
+        # Gives up on writing this run's archive to the mirror arcsets[i].
+        logging.error('Failed to create new {} backup at {}: {}'.format(
+            type_word, dest_paths[i], exc_str(error)))
+        if arcsets[i].latest() and arcsets[i].latest().is_current:
+            arcsets[i].remove(arcsets[i].latest())
+        live.remove(i)
 
     while True:
+        for i in live[1:]:
+            if reference_name(arcsets[i]) != reference_name(arcset):
+                drop(i, BackupError(
+                    'it would be relative to {} instead of {}, as the '
+                    'archives there differ from those in {}'.format(
+                        reference_name(arcsets[i]) or 'nothing',
+                        reference_name(arcset), cfg.dest_dir)))
+        outputs = [ make_output(cfg, arcsets[i],
+                                arcsets[i].create_current_temp(), cleaners[i])
+                    for i in live ]
+        checksummer = Checksummer(cfg.checksum) if cfg.checksum else None
+        throttle = make_throttle(cfg)
+        progress = Progress(cfg, kind, arcset.predict_size(kind, history=1))
+        full_command = command
+        if catalogs:
+            full_command = command + catalogs.isolation_args(arcset.latest())
         try:
-            status, num_bytes = proc_write(command, dest_path_temp,
-                                      cfg.capacity - arcset.total_size(),
-                                      cleaner, good_exit_codes)
-            # Note: if this returns a bad (nonzero) status, or raises and
-            # exception, the file at 'dest_temp_path' has already been removed.
+            with spans.span('write archive'):
+                status = proc_write(full_command, outputs, good_exit_codes,
+                                    checksummer, cfg.pipe_size,
+                                    cfg.ring_buffer_size, throttle, metrics,
+                                    progress, cfg.file_messages,
+                                    lambda: set_dar_priority(cfg))
+            # Note: if this raises an exception, or an output is not
+            # completed, then its file has already been removed.
             break
         except NoRemovalCandidatesError:
             # Remove the current archive, and see if we are now able to delete
             # an archive.  It's possible that it was previously impossible
-            # because the current archive was dependent on the previous one
-            # (i.e. it was incremental).
+            # because the current archive was dependent on an earlier one
+            # (i.e. it was incremental or differential).  Only the cleaner of
+            # cfg.dest_dir gets here: if a mirror runs out of archives to
+            # remove, only writing to that mirror fails (see _make_room()).
             # Note: 'cleaner()' either successfully removes an old archive, or
             # throws an error. Hence, we cannot get into an infinite loop.
             arcset.remove(arcset.latest())
-            cleaner()
-            # As 'arcset.latest()' may have changed, re-genereate the dar
-            # command
+            cleaners[0]()
+            # As 'arcset.latest()' may have changed, re-generate the dar
+            # command; mirrors whose archives no longer match are dropped.
             command = make_command()
-            arcset.append_current(now, is_incr)
+            arcset.append_current(now, kind)
+
+    for i, output in zip(live, outputs):
+        a, dest_path, predicted_size = \
+            arcsets[i], dest_paths[i], predicted_sizes[i]
+        num_bytes = output.num_written
+        if output.completed:
+            manifest_temp_path = None
+            if checksummer:
+                manifest_temp_path = a.latest().manifest_path() + '.part'
+                checksummer.write_manifest(manifest_temp_path,
+                                           os.path.basename(dest_path))
+            with spans.span('commit archive'):
+                a.commit_current(output.filename, manifest_temp_path)
+            logging.info('Created new {} backup at {} ({} bytes)'.format(
+                type_word, dest_path, num_bytes))
+            if predicted_size:
+                logging.info('Predicted size was {} bytes, {:+.1f}% off'
+                             .format(predicted_size,
+                                     100.0 * (predicted_size - num_bytes) /
+                                     max(num_bytes, 1)))
+        elif output.error:
+            logging.error('Failed to create new {} backup at {}: {}'.format(
+                type_word, dest_path, exc_str(output.error)))
+        else:
+            logging.error('Failed to create new {} backup at {}: dar failed '
+                          '({}) after writing {} bytes'.format(
+                              type_word, dest_path, status, num_bytes))
+
+    if catalogs:
+        with spans.span('prune catalogs'):
+            catalogs.prune(arcset)
+
+
+def consolidate(cfg, now, arcsets, metrics=None):
+    # Merges the oldest full archive that only the incremental archive
+    # following it is relative to with that archive, using dar, into a full
+    # archive which replaces the incremental one.  The old full archive is
+    # then free to be removed by the removal policy.  Mirrors are only
+    # consolidated likewise if their oldest such pair of archives is the
+    # same.
+    # only needed here (and in backup()); slow to import
+    from procwrite import proc_write
+    from checksum import Checksummer
+    from catalogs import CatalogCache
+    arcset = arcsets[0]
+    for a in arcsets:
+        pair = a.consolidation_candidate()
+        if pair and pair[0].timestamp == pair[1].timestamp:
+            logging.info('Removing {}, which was already consolidated into {}'
+                         .format(pair[1].path(), pair[0].path()))
+            a.delete(pair[1])
+    candidate = arcset.consolidation_candidate()
+    if not candidate:
+        logging.debug('Nothing to consolidate: ' + cfg.name)
+        return
+    full, incr = candidate
+    basename = arcset.basename_for(incr.timestamp, 'full')
+    names = (full.basename(), incr.basename())
+    targets = [ ]
+    for a in arcsets:
+        pair = a.consolidation_candidate()
+        if pair and tuple(arc.basename() for arc in pair) == names:
+            existing = a.find(basename)
+            if existing:
+                raise BackupError('Cannot consolidate {}: {} exists'.format(
+                    incr.path(), existing.path()))
+            targets.append(a)
+        else:
+            logging.info('Not consolidating mirror: {!s}'.format(a))
+    for a in targets:
+        logging.info('Existing archives: {!s}'.format(a))
+    logging.info('Consolidating {} and {} into a full backup: {}'.format(
+        full.path(), incr.path(), cfg.name))
+    if metrics:
+        metrics.kind = 'consolidation'
+    catalogs = CatalogCache(cfg) if cfg.catalog_cache else None
+
+    # '-ak' keeps compressed data as it is; '-/ Oo' lets the entries of the
+    # incremental archive override those of the full one.
+    command = [ '/usr/bin/dar', '-+', '-', '-A', full.basepath(),
+                '-@', incr.basepath(), '-ak', '-/', 'Oo' ]
+
+    cleaners = [ make_cleaner(cfg.rmpolicy, a, now, cfg.cleaner_watermark,
+                              catalogs if a is arcset else None)
+                 for a in targets ]
+    outputs = [ make_output(cfg, a, a.create_temp(basename), cleaner)
+                for a, cleaner in zip(targets, cleaners) ]
+    checksummer = Checksummer(cfg.checksum) if cfg.checksum else None
+    with spans.span('merge archives'):
+        status = proc_write(command, outputs, (0,), checksummer,
+                            cfg.pipe_size, cfg.ring_buffer_size,
+                            make_throttle(cfg), metrics,
+                            Progress(cfg, 'consolidation', full.size),
+                            cfg.file_messages,
+                            lambda: set_dar_priority(cfg))
+
+    for a, output in zip(targets, outputs):
+        path = os.path.join(os.path.dirname(output.filename), basename)
+        if output.completed:
+            manifest_temp_path = None
+            if checksummer:
+                manifest_temp_path = path + '.manifest.part'
+                checksummer.write_manifest(manifest_temp_path, basename)
+            a.replace(a.find(incr.basename()), output.filename,
+                      manifest_temp_path)
+            logging.info('Created consolidated full backup at {} ({} bytes), '
+                         'replacing {}'.format(path, output.num_written,
+                                               incr.basename()))
+        elif output.error:
+            logging.error('Failed to create consolidated full backup at {}: '
+                          '{}'.format(path, exc_str(output.error)))
+        else:
+            logging.error('Failed to create consolidated full backup at {}: '
+                          'dar failed ({}) after writing {} bytes'.format(
+                              path, status, output.num_written))
+
+    if catalogs:
+        catalogs.prune(arcset)
 
-    if status in good_exit_codes:
-        os.rename(dest_path_temp, dest_path)
-        logging.info('Created new {} backup at {} ({} bytes)'.format(
-            type_word, dest_path, num_bytes))
-    else:
-        logging.error('Failed to create new {} backup at {}: dar failed ({}) '
-                      'after writing {} bytes'.format(
-                          type_word, dest_path, status, num_bytes))
+
+def make_output(cfg, arcset, temp_path, cleaner):
+    from procwrite import Output  # only needed here
+    return Output(temp_path, cfg.capacity - arcset.total_size(), cleaner,
+                  cfg.copy_method, cfg.writeback_interval, cfg.reserve,
+                  cfg.preallocation_size)
+
+
+def make_throttle(cfg):
+    if cfg.bandwidth_limit or cfg.throttle_on_pressure:
+        return Throttle(cfg.bandwidth_limit, cfg.throttle_on_pressure)
+    return None
+
+
+@contextmanager
+def priority(cfg):
+    # Runs the body with the configured CPU and I/O priority, which the
+    # threads that write to the destination, and dar, inherit.  The previous
+    # priority is restored afterwards, so that it does not carry over to any
+    # further sections.
+    old_nice = old_ioprio = None
+    if cfg.nice is not None:
+        try:
+            old_nice = os.getpriority(os.PRIO_PROCESS, 0)
+            os.setpriority(os.PRIO_PROCESS, 0, cfg.nice)
+        except OSError as e:
+            logging.warning('Failed to set niceness to {}: {}'.format(
+                cfg.nice, exc_str(e)))
+    if cfg.ioprio is not None:
+        try:
+            old_ioprio = libc.ioprio_get()
+            libc.ioprio_set(*cfg.ioprio)
+        except OSError as e:
+            logging.warning('Failed to set I/O priority: {}'.format(
+                exc_str(e)))
+    try:
+        yield
+    finally:
+        if old_nice is not None:
+            try:
+                os.setpriority(os.PRIO_PROCESS, 0, old_nice)
+            except OSError as e:
+                # Only root may lower the niceness.
+                logging.warning('Failed to restore niceness to {}: {}'.format(
+                    old_nice, exc_str(e)))
+        if old_ioprio is not None:
+            try:
+                libc.ioprio_set(*old_ioprio)
+            except OSError as e:
+                logging.warning('Failed to restore I/O priority: {}'.format(
+                    exc_str(e)))
+
+
+def set_dar_priority(cfg):
+    # Called in the dar process before it is executed.  It already inherits
+    # the priority set by priority(), but this makes sure it runs with the
+    # configured one from the start, whatever thread started it.  Errors
+    # cannot be logged here; priority() has reported them.
+    try:
+        if cfg.nice is not None:
+            os.setpriority(os.PRIO_PROCESS, 0, cfg.nice)
+        if cfg.ioprio is not None:
+            libc.ioprio_set(*cfg.ioprio)
+    except OSError:
+        pass
+
+
+def preclean(cfg, arcset, cleaner, predicted_size):
+    # Remove archives up front, so as to have room for an archive of the
+    # predicted size.  This avoids having to remove archives while dar is
+    # running (and blocked, waiting for us to write out its output).
+    available = available_space(cfg, arcset)
+    logging.info('Predicted size of new archive is {} bytes; {} bytes '
+                 'available'.format(predicted_size, available))
+    needed = predicted_size - available
+    if needed <= 0:
+        return
+    try:
+        freed = cleaner.free(needed)
+    except BackupError as e:
+        logging.info('Cannot make room for the predicted size up front: {}'
+                     .format(e))
+        return
+    if freed < needed:
+        logging.info('Could only free {} of {} bytes up front'.format(
+            freed, needed))
+
+
+def available_space(cfg, arcset):
+    # Returns the space available for a new archive: limited both by the
+    # configured capacity, and by the free space on disk (minus the reserve).
+    return min(cfg.capacity - arcset.total_size(),
+               arcset.disk_space() - cfg.reserve)
 
 
 def clean_parts(path):
     for fn in os.listdir(path):
-        if fn.endswith('.dar.part'):
+        if fn.endswith('.dar.part') or fn.endswith('.dar.manifest.part'):
             fullpath = os.path.join(path, fn)
             os.remove(fullpath)
             logging.info('Removed left-over partial backup {}'.format(fullpath))
@@ -229,21 +935,41 @@ def clean_parts(path):
 class LogFileHandler(RotatingFileHandler):
     def __init__(self, filename, **kwargs):
         self.__doneInitialRollover = not os.path.exists(filename)
+        self.__batched = False
         RotatingFileHandler.__init__(self, filename, **kwargs)
 
     def emit(self, record):
         if not self.__doneInitialRollover:
             self.doRollover()
             self.__doneInitialRollover = True
+        self.__batched = getattr(record, 'batched', False)
         return RotatingFileHandler.emit(self, record)
 
+    def shouldRollover(self, record):
+        # We only roll over before the first record (see emit()); skip the
+        # checks that RotatingFileHandler makes for every record.
+        return False
+
+    def flush(self):
+        # Called after each record is written; a 'batched' record is followed
+        # by more at once (see procwrite._LoggerThread), so flushing can wait.
+        if not self.__batched:
+            RotatingFileHandler.flush(self)
+
+
+sighup_received = False
+
+def handle_sighup(sig, stk):
+    global sighup_received
+    sighup_received = True
+
 
 def handle_sigterm(sig, stk):
     raise TerminatedSignal()
 
 
 if __name__ == '__main__':
-    if sys.version_info < (3, 3):
-        sys.exit('Python >= 3.3 required')
+    if sys.version_info < (3, 6):
+        sys.exit('Python >= 3.6 required')
     status = main()
     sys.exit(status)
@@ -17,26 +17,37 @@
 
 import re, os, os.path, logging
 from datetime import datetime
-from operator import attrgetter
 
 from errors import BackupError
+from arcindex import ArchiveIndex
 
 _ARCHIVE_BASENAME_SUFFIX_PAT = \
-        r'-(\d\d\d\d)-(\d\d)-(\d\d)-(\d\d)(\d\d)-(full|incr)\.1\.dar$'
+        r'-(\d\d\d\d)-(\d\d)-(\d\d)-(\d\d)(\d\d)-(full|incr|diff)\.1\.dar$'
 
 _BASENAME_SUFFIX_RE = re.compile(_ARCHIVE_BASENAME_SUFFIX_PAT)
 
 
+# Kinds of archive: 'full' ones are self-contained; 'incr' (incremental) ones
+# are relative to the preceding archive, and 'diff' (differential) ones to the
+# latest full archive preceding them.
+KINDS = ('full', 'incr', 'diff')
+
 class Archive:
-    def __init__(self, basedir, basename, timestamp, is_incr, size):
+    def __init__(self, basedir, basename, timestamp, kind, size):
         self._basedir = basedir
         self._basename = basename
         self.timestamp = timestamp
-        self.is_incremental = is_incr
+        self.kind = kind
+        self.is_incremental = kind != 'full'  # i.e. has a reference archive
         self.size = size
         self._prev = self._next = None
+        self._reference = None
+        self._num_dependents = 0
         self.is_current = False
 
+    def basename(self):
+        return self._basename
+
     def path(self):
         return os.path.join(self._basedir, self._basename)
 
@@ -45,25 +56,36 @@ class Archive:
         assert path.endswith('.1.dar')
         return path[:-6]
 
+    def manifest_path(self):
+        return self.path() + '.manifest'
+
     def prev(self): return self._prev
 
     def next(self): return self._next
 
+    def reference(self):
+        # Returns the archive that this one is relative to, if any.
+        return self._reference
+
     def has_dependent(self):
-        return self._next and self._next.is_incremental
+        # Whether other archives are relative to this one.
+        return self._num_dependents > 0
 
 
 class ArchiveSet:
     def __init__(self, name, path):
         self._name = name
         self._basedir = path
+        self._index = ArchiveIndex(path)
         archives = [ ]
-        for fn in os.listdir(path):
-            archive = self._archive_at_path(fn)
+        for fn, entry in self._index.load(_scan).items():
+            archive = self._archive_at_path(fn, entry['size'])
             if archive:
                 logging.debug('Found existing archive {}'.format(fn))
                 archives.append(archive)
-        archives.sort(key=attrgetter('timestamp'))
+        # A full archive sorts before an incremental one of the same time,
+        # which it can only be the consolidation of (see replace()).
+        archives.sort(key=lambda arc: (arc.timestamp, arc.kind != 'full'))
         if len(archives) > 0 and archives[0].is_incremental:
             raise BackupError('Oldest archive {} is incremental'
                               .format(archive.path()))
@@ -90,16 +112,32 @@ class ArchiveSet:
     def total_size(self):
         return self._total_size
 
-    def append_current(self, timestamp, is_incr):
-        basename = "{}-{:%Y-%m-%d-%H%M}-{}.1.dar".format(
-            self._name, timestamp,
-            'incr' if is_incr else 'full')
-        archive = Archive(self._basedir, basename, timestamp, is_incr, None)
+    def disk_space(self):
+        # Returns the free space on the filesystem holding the archives.
+        st = os.statvfs(self._basedir)
+        return st.f_bavail * st.f_frsize
+
+    def basename_for(self, timestamp, kind):
+        return "{}-{:%Y-%m-%d-%H%M}-{}.1.dar".format(self._name, timestamp,
+                                                    kind)
+
+    def find(self, basename):
+        for arc in self:
+            if arc._basename == basename:
+                return arc
+        return None
+
+    def append_current(self, timestamp, kind):
+        basename = self.basename_for(timestamp, kind)
+        archive = Archive(self._basedir, basename, timestamp, kind, None)
         archive.is_current = True
         self._append(archive)
         return os.path.join(self._basedir, basename)
 
     def _append(self, archive):
+        archive._reference = self.reference_for(archive.kind)
+        if archive._reference:
+            archive._reference._num_dependents += 1
         if self._first is None:
             self._first = archive
         else:
@@ -110,15 +148,154 @@ class ArchiveSet:
         if archive.size is not None:
             self._total_size += archive.size
 
+    def create_current_temp(self):
+        # Creates the (empty) file that the current archive is to be written
+        # to.
+        return self.create_temp(self._last._basename)
+
+    def create_temp(self, basename):
+        # The index is kept out of date until the file is committed (see
+        # ArchiveIndex.add_temp()).
+        path = os.path.join(self._basedir, basename + '.part')
+        self._index.add_temp(path)
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+        return path
+
+    def commit_current(self, temp_path, manifest_temp_path=None):
+        # Moves the completed current archive from 'temp_path' into place,
+        # along with its manifest, if any.
+        archive = self._last
+        assert archive.is_current
+        with self._index.transaction(_scan) as entries:
+            if manifest_temp_path:
+                os.rename(manifest_temp_path, archive.manifest_path())
+            os.rename(temp_path, archive.path())
+            self._index.remove_temp(temp_path)
+            _fsync_dir(self._basedir)
+            archive.size = os.path.getsize(archive.path())
+            entries[archive._basename] = _index_entry(archive)
+        archive.is_current = False
+        self._total_size += archive.size
+
+    def consolidation_candidate(self):
+        # Returns the oldest pair of a full archive and the incremental
+        # archive following it, such that no other archive is relative to the
+        # full one, and some archive is relative to the incremental one (so
+        # that the removal policy cannot remove either while they are being
+        # merged); or None if there is no such pair.
+        for arc in self:
+            incr = arc._next
+            if (arc.kind == 'full' and arc._num_dependents == 1 and incr and
+                    incr.kind == 'incr' and incr.has_dependent()):
+                return arc, incr
+        return None
+
+    def replace(self, archive, temp_path, manifest_temp_path=None):
+        # Replaces the incremental 'archive' with the full archive at
+        # 'temp_path' (and its manifest, if any), the consolidation of it
+        # with its reference archive: in its place, with the same timestamp.
+        # Archives that were relative to it become relative to the new one.
+        # Returns the new archive.
+        full = Archive(self._basedir,
+                       self.basename_for(archive.timestamp, 'full'),
+                       archive.timestamp, 'full', None)
+        with self._index.transaction(_scan) as entries:
+            if manifest_temp_path:
+                os.rename(manifest_temp_path, full.manifest_path())
+            os.rename(temp_path, full.path())
+            self._index.remove_temp(temp_path)
+            _fsync_dir(self._basedir)
+            # Were we interrupted here, the incremental archive would remain,
+            # relative to the new archive, which it sorts after; it is then
+            # removed by the next consolidation.
+            full.size = os.path.getsize(full.path())
+            entries[full._basename] = _index_entry(full)
+            os.remove(archive.path())
+            try:
+                os.remove(archive.manifest_path())
+            except FileNotFoundError:
+                pass
+            entries.pop(archive._basename, None)
+        full._prev = archive._prev
+        full._next = archive._next
+        full._prev._next = full
+        if full._next:
+            full._next._prev = full
+        else:
+            self._last = full
+        archive._prev = archive._next = archive._reference = None
+        self._total_size += full.size - archive.size
+        self._relink()
+        return full
+
+    def _relink(self):
+        # Recomputes which archive each archive is relative to.
+        last = last_full = None
+        for arc in self:
+            arc._num_dependents = 0
+        for arc in self:
+            arc._reference = { 'incr': last, 'diff': last_full }.get(arc.kind)
+            if arc._reference:
+                arc._reference._num_dependents += 1
+            last = arc
+            if arc.kind == 'full':
+                last_full = arc
+
+    def delete(self, archive):
+        # Removes the archive from the set, and deletes it from disk.
+        with self._index.transaction(_scan) as entries:
+            os.remove(archive.path())
+            try:
+                os.remove(archive.manifest_path())
+            except FileNotFoundError:
+                pass
+            entries.pop(archive._basename, None)
+        self.remove(archive)
+
     def remove(self, archive):
         if self._first == archive: self._first = archive._next
         if self._last == archive: self._last = archive._prev
         if archive._prev: archive._prev._next = archive._next
         if archive._next: archive._next._prev = archive._prev
         archive._prev = archive._next = None
+        if archive._reference:
+            archive._reference._num_dependents -= 1
+            archive._reference = None
         self._count -= 1
         if archive.size is not None:
             self._total_size -= archive.size
+        if archive._num_dependents:
+            # only when completing an interrupted consolidation (see replace())
+            self._relink()
+
+    def snapshot(self):
+        # Returns a copy of this set, which may be modified (using remove())
+        # without affecting this one, or the disk.  Each archive in the copy
+        # refers to its counterpart in this set as 'original'.
+        snapshot = ArchiveSet.__new__(ArchiveSet)
+        snapshot._name = self._name
+        snapshot._basedir = self._basedir
+        snapshot._index = None
+        snapshot._first = snapshot._last = None
+        snapshot._count = 0
+        snapshot._total_size = 0
+        for arc in self:
+            copy = Archive(arc._basedir, arc._basename, arc.timestamp,
+                           arc.kind, arc.size)
+            copy.is_current = arc.is_current
+            copy.original = arc
+            snapshot._append(copy)
+        return snapshot
+
+    def predict_size(self, kind, history=3):
+        # Predicts the size of the next archive of the given kind: the largest
+        # of the latest 'history' ones of that kind.  Returns None if there is
+        # no such archive.
+        sizes = [ arc.size for arc in self
+                  if arc.kind == kind and not arc.is_current ]
+        if not sizes:
+            return None
+        return max(sizes[-history:])
 
     def first(self):
         return self._first
@@ -126,15 +303,51 @@ class ArchiveSet:
     def latest(self):
         return self._last
 
-    def _archive_at_path(self, basename):
+    def reference_for(self, kind):
+        # Returns the archive that a new archive of the given kind would be
+        # relative to.
+        if kind == 'incr':
+            return self._last
+        if kind == 'diff':
+            arc = self._last
+            while arc and arc.kind != 'full':
+                arc = arc._prev
+            return arc
+        return None
+
+    def _archive_at_path(self, basename, size):
         if basename.startswith(self._name):
             m = _BASENAME_SUFFIX_RE.match(basename[len(self._name):])
             if m:
-                return Archive(self._basedir, basename,
-                               datetime(int(m.group(1)), int(m.group(2)),
-                                        int(m.group(3)), int(m.group(4)),
-                                        int(m.group(5))),
-                               m.group(6) == 'incr',
-                               os.path.getsize(os.path.join(self._basedir,
-                                                            basename)))
+                return Archive(self._basedir, basename, _timestamp(m),
+                               m.group(6), size)
         return None
+
+def _fsync_dir(path):
+    # Makes renames within directory 'path' durable.
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _timestamp(m):
+    return datetime(int(m.group(1)), int(m.group(2)), int(m.group(3)),
+                    int(m.group(4)), int(m.group(5)))
+
+def _index_entry(archive):
+    return { 'timestamp': '{:%Y-%m-%d %H:%M}'.format(archive.timestamp),
+             'type': archive.kind,
+             'size': archive.size }
+
+def _scan(basedir):
+    # Returns index entries for all archives in 'basedir', whatever their base
+    # name, as several sections may share a destination directory.
+    entries = { }
+    for fn in os.listdir(basedir):
+        m = _BASENAME_SUFFIX_RE.search(fn)
+        if m and m.start() > 0:
+            entries[fn] = { 'timestamp': '{}-{}-{} {}:{}'.format(*m.groups()),
+                            'type': m.group(6),
+                            'size': os.path.getsize(os.path.join(basedir, fn)) }
+    return entries
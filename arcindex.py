@@ -0,0 +1,140 @@
+# Copyright 2013 Carlo Teubner
+#
+# This file is part of darbup.
+#
+# darbup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# darbup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with darbup.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, os.path, json, fcntl, logging
+from contextlib import contextmanager
+
+from errors import exc_str
+
+INDEX_BASENAME = '.darbup-index'
+
+_VERSION = 1
+
+# The index lives in the destination directory, and maps the basename of every
+# archive in there to a dict holding its timestamp, type and size.
+#
+# Any creation, removal or rename of a file in the directory updates the
+# directory's mtime.  After every update of the index, we set the index file's
+# mtime to the current time, which is therefore no earlier than the
+# directory's.  So as long as the directory's mtime is not later than the
+# index file's, nothing has changed behind our back, and the index can be
+# trusted.  Otherwise, we rescan the directory.
+
+class ArchiveIndex:
+    def __init__(self, basedir):
+        self._basedir = basedir
+        self._path = os.path.join(basedir, INDEX_BASENAME)
+        self._temp_paths = set()
+
+    def is_fresh(self):
+        try:
+            index_mtime = os.stat(self._path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        return os.stat(self._basedir).st_mtime_ns <= index_mtime
+
+    def invalidate(self):
+        # Makes the index out of date (even if the directory is changed within
+        # the granularity of its mtime), so the next user rescans the
+        # directory.
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
+
+    def add_temp(self, path):
+        # Notes that the partial file 'path' is about to be created.  Until it
+        # is passed to remove_temp(), the index is kept out of date, even by
+        # transactions, so that if we are interrupted, the next run rescans
+        # the directory and removes the file.
+        self._temp_paths.add(path)
+        self.invalidate()
+
+    def remove_temp(self, path):
+        self._temp_paths.discard(path)
+
+    def load(self, scan):
+        if self.is_fresh():
+            entries = self._read()
+            if entries is not None:
+                return entries
+        with self.transaction(scan) as entries:
+            return entries
+
+    @contextmanager
+    def transaction(self, scan):
+        # Yields the current entries (a dict).  The caller is to make its
+        # changes to the directory and update the dict accordingly; the index
+        # is then rewritten.  If the index was stale to begin with, the
+        # directory is rescanned after the caller's changes instead.
+        lock_fd = self._lock()
+        try:
+            entries = self._read() if self.is_fresh() else None
+            is_fresh = entries is not None
+            if not is_fresh:
+                entries = { }
+            yield entries
+            if not is_fresh:
+                logging.debug('Archive index {} is out of date; rescanning'
+                              .format(self._path))
+                entries.clear()
+                entries.update(scan(self._basedir))
+            if self._temp_paths:
+                self.invalidate()
+            else:
+                self._write(entries)
+        finally:
+            if lock_fd is not None:
+                os.close(lock_fd)
+
+    def _lock(self):
+        try:
+            fd = os.open(self._basedir, os.O_RDONLY | os.O_DIRECTORY)
+        except OSError as e:
+            logging.debug('Cannot lock {}: {}'.format(self._basedir,
+                                                      exc_str(e)))
+            return None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except OSError as e:
+            logging.debug('Cannot lock {}: {}'.format(self._basedir,
+                                                      exc_str(e)))
+        return fd
+
+    def _read(self):
+        try:
+            with open(self._path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.debug('Cannot read archive index {}: {}'.format(
+                self._path, exc_str(e)))
+            return None
+        if data.get('version') != _VERSION:
+            return None
+        return data['archives']
+
+    def _write(self, entries):
+        temp_path = self._path + '.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump({ 'version': _VERSION, 'archives': entries }, f,
+                          indent=1, sort_keys=True)
+            os.replace(temp_path, self._path)
+            os.utime(self._path)
+        except OSError as e:
+            logging.warning('Failed to write archive index {}: {}'.format(
+                self._path, exc_str(e)))
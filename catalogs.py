@@ -0,0 +1,98 @@
+# Copyright 2013 Carlo Teubner
+#
+# This file is part of darbup.
+#
+# darbup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# darbup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with darbup.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, os.path, subprocess, logging
+
+from errors import BackupError, exc_str
+
+_SUFFIX = '.1.dar'
+
+class CatalogCache:
+    # Local copies of the catalogs of a section's archives, isolated by dar.
+    # For an incremental backup, dar can read the catalog of the reference
+    # archive from here, rather than from the archive itself, so the (slow,
+    # and possibly sleeping) destination disk need not be read.  Catalogs are
+    # isolated while their archive is being created, or else on first use.
+
+    def __init__(self, cfg):
+        self._dir = os.path.join(cfg.state_dir, 'catalogs',
+                                 cfg.name.replace('/', '_'))
+
+    def basepath(self, archive):
+        return os.path.join(self._dir, os.path.basename(archive.basepath()))
+
+    def isolation_args(self, archive):
+        # Returns dar arguments that make it isolate the catalog of 'archive'
+        # while creating it.
+        os.makedirs(self._dir, exist_ok=True)
+        self.evict(archive)  # else dar would ask whether to overwrite it
+        return [ '-@', self.basepath(archive) ]
+
+    def reference(self, archive):
+        # Returns what to pass to dar's -A option in order to use 'archive' as
+        # the reference: its catalog, isolating it first if it is missing, or
+        # failing that, the archive itself.
+        basepath = self.basepath(archive)
+        if not os.path.exists(basepath + _SUFFIX):
+            try:
+                self._isolate(archive)
+            except (BackupError, OSError) as e:
+                logging.warning('Failed to isolate catalog of {}, using the '
+                                'archive itself: {}'.format(archive.path(),
+                                                            exc_str(e)))
+                return archive.basepath()
+        return basepath
+
+    def evict(self, archive):
+        try:
+            os.remove(self.basepath(archive) + _SUFFIX)
+        except FileNotFoundError:
+            pass
+
+    def prune(self, arcset):
+        # Removes the catalogs of archives that are no longer in 'arcset' (or
+        # that were never completed).
+        keep = set(os.path.basename(arc.basepath()) + _SUFFIX
+                   for arc in arcset if not arc.is_current)
+        try:
+            filenames = os.listdir(self._dir)
+        except FileNotFoundError:
+            return
+        for fn in filenames:
+            if fn not in keep:
+                logging.debug('Removing catalog {}'.format(fn))
+                os.remove(os.path.join(self._dir, fn))
+
+    def _isolate(self, archive):
+        logging.info('Isolating catalog of {}'.format(archive.path()))
+        os.makedirs(self._dir, exist_ok=True)
+        basepath = self.basepath(archive)
+        temp_basepath = basepath + '.part'
+        try:
+            os.remove(temp_basepath + _SUFFIX)
+        except FileNotFoundError:
+            pass
+        proc = subprocess.Popen(
+            [ '/usr/bin/dar', '-C', temp_basepath, '-A', archive.basepath() ],
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, universal_newlines=True)
+        for line in proc.stdout:
+            logging.debug('dar: ' + line.rstrip('\n'))
+        status = proc.wait()
+        if status != 0:
+            raise BackupError('dar exited with status {}'.format(status))
+        os.rename(temp_basepath + _SUFFIX, basepath + _SUFFIX)
@@ -0,0 +1,98 @@
+# Copyright 2013 Carlo Teubner
+#
+# This file is part of darbup.
+#
+# darbup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# darbup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with darbup.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib, json, os, os.path, threading, fcntl, logging
+
+from errors import BackupError
+from ringbuffer import F_SETPIPE_SZ
+
+BLOCK_SIZE = 64 << 20
+
+_PIPE_SIZE = 1 << 20
+_READ_SIZE = 1 << 20
+
+class Checksummer(threading.Thread):
+    # Computes the checksum of a stream of data, both in whole and per block of
+    # BLOCK_SIZE bytes, in a thread of its own.  The data is to be written (or
+    # rather, tee()d) to the pipe 'fd'.
+
+    def __init__(self, algorithm):
+        threading.Thread.__init__(self, name='checksummer')
+        self.daemon = True
+        try:
+            hashlib.new(algorithm)
+        except ValueError:
+            raise BackupError('Invalid checksum algorithm: "{}"'.format(
+                algorithm))
+        self._algorithm = algorithm
+        self._read_fd, self.fd = os.pipe()
+        try:
+            fcntl.fcntl(self.fd, F_SETPIPE_SZ, _PIPE_SIZE)
+        except OSError:
+            pass  # we'll make do with the default size
+        self._digest = None
+        self._block_digests = [ ]
+        self._size = 0
+
+    def finish(self):
+        # Signals the end of the data, and waits for the thread to finish.
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.ident is None:  # never started
+            os.close(self._read_fd)
+        elif self.is_alive():
+            self.join()
+
+    def write_manifest(self, path, archive_basename):
+        if self._digest is None:  # the thread failed, or never ran
+            raise BackupError('No {} checksum to write to {}'.format(
+                self._algorithm, path))
+        with open(path, 'w') as f:
+            json.dump({ 'archive': archive_basename,
+                        'size': self._size,
+                        'algorithm': self._algorithm,
+                        'digest': self._digest,
+                        'block_size': BLOCK_SIZE,
+                        'blocks': self._block_digests }, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def run(self):
+        whole = hashlib.new(self._algorithm)
+        block = hashlib.new(self._algorithm)
+        block_left = BLOCK_SIZE
+        buf = bytearray(_READ_SIZE)
+        view = memoryview(buf)
+        with open(self._read_fd, 'rb', buffering=0) as f:
+            while True:
+                n = f.readinto(view[:min(_READ_SIZE, block_left)])
+                if not n:
+                    break
+                whole.update(view[:n])
+                block.update(view[:n])
+                self._size += n
+                block_left -= n
+                if block_left == 0:
+                    self._block_digests.append(block.hexdigest())
+                    block = hashlib.new(self._algorithm)
+                    block_left = BLOCK_SIZE
+        if block_left < BLOCK_SIZE:
+            self._block_digests.append(block.hexdigest())
+        self._digest = whole.hexdigest()
+        logging.debug('{} of {} bytes: {}'.format(self._algorithm, self._size,
+                                                  self._digest))
@@ -17,18 +17,141 @@
 
 from errors import BackupError, NoRemovalCandidatesError
 
-import logging, os, os.path
+import logging, threading
 
-def make_cleaner(rmpolicy, arcset, now):
-    def cleaner():
-        arc = rmpolicy(arcset, now)
+import spans
+
+def make_cleaner(rmpolicy, arcset, now, watermark=0, catalogs=None):
+    if watermark > 0:
+        return BackgroundCleaner(rmpolicy, arcset, now, catalogs, watermark)
+    return Cleaner(rmpolicy, arcset, now, catalogs)
+
+class Cleaner:
+    # Removes archives chosen by the removal policy 'rmpolicy', one per call,
+    # returning the number of bytes freed.  Their catalogs are evicted from
+    # 'catalogs', if given.
+
+    def __init__(self, rmpolicy, arcset, now, catalogs=None):
+        self.rmpolicy = rmpolicy
+        self._arcset = arcset
+        self._now = now
+        self._catalogs = catalogs
+        self.removed = [ ]  # (basename, size) of each archive removed
+
+    def __call__(self):
+        with spans.span('removal policy'):
+            arc = self.rmpolicy(self._arcset, self._now)
         if not arc:
-            raise NoRemovalCandidatesError(rmpolicy, arcset)
-        size = os.path.getsize(arc.path())
+            raise NoRemovalCandidatesError(self.rmpolicy, self._arcset)
+        return self._remove(arc)
+
+    def free(self, nbytes):
+        # Removes archives until at least 'nbytes' bytes are freed, or no more
+        # archives can be removed.  Returns the number of bytes freed.
+        freed = 0
+        with spans.span('removal policy'):
+            plan = self.rmpolicy.plan(self._arcset, self._now, nbytes)
+        for arc in plan:
+            freed += self._remove(arc)
+        return freed
+
+    def _remove(self, arc):
+        size = arc.size
         logging.info('Removing {}, chosen by removal policy "{}", '
-                     'to free up {} bytes'.format(arc.path(), rmpolicy.name,
-                                                  size))
-        os.remove(arc.path())
-        arcset.remove(arc)
+                     'to free up {} bytes'.format(arc.path(),
+                                                  self.rmpolicy.name, size))
+        with spans.span('remove archive'):
+            self._arcset.delete(arc)
+        if self._catalogs:
+            self._catalogs.evict(arc)
+        self.removed.append((arc.basename(), size))
         return size
-    return cleaner
+
+    def progress(self, limit):
+        # Called by the writer with the number of bytes it may still write.
+        # Returns the number of bytes freed meanwhile (which the writer adds to
+        # its limit).
+        return 0
+
+    def close(self):
+        pass
+
+class BackgroundCleaner(Cleaner):
+    # While the writer is running, removes archives in a background thread
+    # whenever the space left drops below 'watermark' bytes, so that the
+    # writer (and hence dar) does not have to wait for the removal of what
+    # may be a very large file.  The writer only waits if it actually runs
+    # out of space.
+
+    def __init__(self, rmpolicy, arcset, now, catalogs, watermark):
+        Cleaner.__init__(self, rmpolicy, arcset, now, catalogs)
+        self._watermark = watermark
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def progress(self, limit):
+        if self._thread is None:
+            self._start()
+        elif self._freed == 0 and limit >= self._watermark:
+            return 0  # fast path: nothing to do (no need to lock)
+        with self._cond:
+            freed = self._freed
+            self._freed = 0
+            self._headroom = limit + freed
+            if self._headroom < self._watermark:
+                self._cond.notify_all()
+        return freed
+
+    def __call__(self):
+        if self._thread is None:
+            return Cleaner.__call__(self)
+        with self._cond:
+            self._headroom = min(self._headroom, 0)
+            self._cond.notify_all()
+            while self._freed == 0 and self._error is None:
+                logging.debug('Waiting for background removal of archives')
+                self._cond.wait()
+            if self._freed == 0:
+                raise self._error
+            freed = self._freed
+            self._freed = 0
+            return freed
+
+    def close(self):
+        if self._thread is None:
+            return
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._thread = None
+
+    def _start(self):
+        self._headroom = self._watermark
+        self._freed = 0
+        self._error = None
+        self._closing = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='background cleaner')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closing and (self._error is not None or
+                                             self._headroom >= self._watermark):
+                    self._cond.wait()
+                if self._closing:
+                    return
+            try:
+                size = Cleaner.__call__(self)
+            except (BackupError, OSError) as e:
+                with self._cond:
+                    self._error = e
+                    self._cond.notify_all()
+                continue
+            with self._cond:
+                self._freed += size
+                self._headroom += size
+                self._cond.notify_all()
@@ -17,11 +17,11 @@
 
 import sys, configparser, os, os.path, re, shlex
 
-import schedules, rmpolicies
+import schedules, rmpolicies, libc
 from errors import BackupError
 
 class Config:
-    def __init__(self, filename):
+    def __init__(self, filename, state_dir, lock_dir):
         if not os.path.exists(filename):
             raise BackupError('Configuration file {} does not exist'
                               .format(filename))
@@ -30,8 +30,27 @@ class Config:
         parser['DEFAULT'] = {
             'FullBackupsInterval': 'monthly',
             'IncrBackupsInterval': 'daily',
+            'DifferentialBackupsInterval': 'never',
+            'ConsolidationInterval': 'never',
             'RemovalPolicy': 'thinning',
             'IgnoreChangingFiles': False,
+            'PreCleaning': True,
+            'PreCleaningMargin': 10,
+            'CleanerWatermark': '0',
+            'Checksum': 'none',
+            'CatalogCache': False,
+            'CopyMethod': 'auto',
+            'PipeSize': '0',
+            'RingBufferSize': '0',
+            'WritebackInterval': '0',
+            'Reserve': '0',
+            'PreallocationSize': '64m',
+            'BandwidthLimit': '0',
+            'ThrottleOnPressure': 0,
+            'Nice': '',
+            'IOPriority': '',
+            'MetricsDirectory': '',
+            'DarFileMessages': 'all',
             'LogsBackupCount': 60
         }
 
@@ -49,17 +68,54 @@ class Config:
             cfg.name = section_name[7:]
             cfg.dest_dir = self._required_value(section, section_name,
                                                 'DestinationDir')
+            cfg.mirror_dirs = shlex.split(section.get('MirrorDirs', ''))
             cfg.dar_args = self._get_dar_args(section, section_name)
             cfg.capacity = self._get_capacity_value(section, section_name)
             cfg.full_intvl = schedules.schedule_by_name(
                                 section['FullBackupsInterval'])
             cfg.incr_intvl = schedules.schedule_by_name(
                                 section['IncrBackupsInterval'])
+            cfg.diff_intvl = schedules.schedule_by_name(
+                                section['DifferentialBackupsInterval'])
+            cfg.consolidation_intvl = schedules.schedule_by_name(
+                                section['ConsolidationInterval'])
             cfg.rmpolicy = rmpolicies.rmpolicy_by_name(section['RemovalPolicy'])
             cfg.ignore_changing_files = self._bool_value(section, section_name,
                                 'IgnoreChangingFiles')
+            cfg.preclean = self._bool_value(section, section_name,
+                                            'PreCleaning')
+            cfg.preclean_margin = self._int_value(section, section_name,
+                                                  'PreCleaningMargin')
+            cfg.cleaner_watermark = self._size_value(section, section_name,
+                                                     'CleanerWatermark')
+            cfg.checksum = self._get_checksum_value(section, section_name)
+            cfg.catalog_cache = self._bool_value(section, section_name,
+                                                 'CatalogCache')
+            cfg.copy_method = self._get_copy_method_value(section,
+                                                          section_name)
+            cfg.pipe_size = self._size_value(section, section_name,
+                                             'PipeSize')
+            cfg.ring_buffer_size = self._size_value(section, section_name,
+                                                    'RingBufferSize')
+            cfg.writeback_interval = self._size_value(section, section_name,
+                                                      'WritebackInterval')
+            cfg.reserve = self._size_value(section, section_name, 'Reserve')
+            cfg.preallocation_size = self._size_value(section, section_name,
+                                                      'PreallocationSize')
+            cfg.bandwidth_limit = self._size_value(section, section_name,
+                                                   'BandwidthLimit')
+            cfg.throttle_on_pressure = self._int_value(section, section_name,
+                                                       'ThrottleOnPressure')
+            cfg.nice = (self._int_value(section, section_name, 'Nice')
+                        if section['Nice'] else None)
+            cfg.ioprio = self._get_ioprio_value(section, section_name)
+            cfg.metrics_dir = section['MetricsDirectory'] or None
+            cfg.file_messages = self._get_file_messages_value(section,
+                                                              section_name)
             cfg.logfilename = section.get('LogfileName')
             cfg.logsbackupcount = int(section.get('LogsBackupCount'))
+            cfg.state_dir = section.get('StateDirectory', state_dir)
+            cfg.lock_dir = lock_dir
             self.instances.append(cfg)
 
     def _required_value(self, section, section_name, name):
@@ -82,10 +138,95 @@ class Config:
                               'is not a valid boolean value'.format(
                                   section_name, name))
 
+    def _int_value(self, section, section_name, name):
+        value = section[name]
+        try:
+            return int(value)
+        except ValueError:
+            raise BackupError('Configuration file section "{}" setting "{}" '
+                              'is not a valid integer'.format(section_name,
+                                                              name))
+
+    SIZE_RE = re.compile(r'[0-9]+[kmgtp]?$', re.IGNORECASE)
+
+    def _size_value(self, section, section_name, name):
+        s = section[name]
+        if not self.SIZE_RE.match(s):
+            raise BackupError('Configuration file section "{}" has bad {} '
+                              'value "{}": must match /^{}/'.format(
+                                  section_name, name, s, self.SIZE_RE.pattern))
+        if s[-1].isdigit():
+            return int(s)
+        return int(s[:-1]) * self.CAPA_SUFFIX_FACTORS[s[-1].lower()]
+
     def _get_dar_args(self, section, section_name):
         s = self._required_value(section, section_name, 'DarArguments')
         return shlex.split(s)
 
+    # hashlib algorithms that checksum.Checksummer may be used with
+    CHECKSUM_ALGORITHMS = ('sha256', 'blake2b')
+
+    def _get_checksum_value(self, section, section_name):
+        s = section['Checksum'].lower()
+        if s == 'none':
+            return None
+        if s not in self.CHECKSUM_ALGORITHMS:
+            raise BackupError('Configuration file section "{}" has bad '
+                              'Checksum value "{}": must be one of none, {}'
+                              .format(section_name, s,
+                                      ', '.join(self.CHECKSUM_ALGORITHMS)))
+        return s
+
+    # names accepted by procwrite.copier_by_name()
+    COPY_METHODS = ('auto', 'splice', 'readwrite')
+
+    def _get_copy_method_value(self, section, section_name):
+        s = section['CopyMethod'].lower()
+        if s not in self.COPY_METHODS:
+            raise BackupError('Configuration file section "{}" has bad '
+                              'CopyMethod value "{}": must be one of {}'
+                              .format(section_name, s,
+                                      ', '.join(self.COPY_METHODS)))
+        return s
+
+    def _get_file_messages_value(self, section, section_name):
+        # Returns N, such that one in every N per-file messages is logged: 1
+        # for all of them, 0 for none.
+        s = section['DarFileMessages'].lower()
+        if s == 'all':
+            return 1
+        if s == 'summary':
+            return 0
+        try:
+            n = int(s)
+        except ValueError:
+            n = 0
+        if n < 1:
+            raise BackupError('Configuration file section "{}" has bad '
+                              'DarFileMessages value "{}": must be all, '
+                              'summary, or a positive number'.format(
+                                  section_name, s))
+        return n
+
+    IOPRIO_CLASSES = { 'realtime': libc.IOPRIO_CLASS_RT,
+                       'best-effort': libc.IOPRIO_CLASS_BE,
+                       'idle': libc.IOPRIO_CLASS_IDLE }
+
+    def _get_ioprio_value(self, section, section_name):
+        # Returns a (class, level) pair, or None.
+        s = section['IOPriority'].lower()
+        if not s:
+            return None
+        name, _, level = s.partition(':')
+        if (name not in self.IOPRIO_CLASSES or
+                level and not (level.isdigit() and int(level) < 8) or
+                level and name == 'idle'):
+            raise BackupError('Configuration file section "{}" has bad '
+                              'IOPriority value "{}": must be idle, '
+                              'best-effort[:LEVEL] or realtime[:LEVEL], with '
+                              'LEVEL from 0 to 7'.format(section_name, s))
+        return self.IOPRIO_CLASSES[name], int(level or 4)
+
     CAPA_RE = re.compile(r'[0-9]+[kmgtp]$', re.IGNORECASE)
     CAPA_SUFFIX_FACTORS = {
         'k': (1 << 10),
@@ -125,30 +266,63 @@ _DEFAULT_CONFIG = b'''\
 # # for further refinement. Compression options like -z may also be useful.
 #
 # DestinationDir=/backup
-# # Directory where to place the generated archive files
+# # Directory where to place the generated archive files. darbup also keeps an
+# # index of the archives in there, in a file named .darbup-index; it is
+# # rebuilt automatically whenever files in the directory are changed by
+# # something other than darbup.
+#
+# MirrorDirs=/backup2 /backup3
+# # Further directories (e.g. on other disks) in which to place a copy of each
+# # generated archive. dar is only run once; its output is duplicated. Each
+# # directory has its own set of archives, with old ones removed independently
+# # according to Capacity and RemovalPolicy. If writing to one of them fails,
+# # the others are not affected. Separate multiple directories by spaces; use
+# # shell-style quoting for directory names containing spaces.
 #
 # Capacity=500G
-# # Maximum amount of space to use for archives. Valid suffixes are K, M, G, T,
-# # P, for KiBi-, MeBi-, GiBi-, TeBi-, PeBi-bytes, respectively.
+# # Maximum amount of space to use for archives (in each of DestinationDir and
+# # MirrorDirs). Valid suffixes are K, M, G, T, P, for KiBi-, MeBi-, GiBi-,
+# # TeBi-, PeBi-bytes, respectively.
 # # Note 1: only archives generated by darbup are taken into account when
 # # calculating used space.
-# # Note 2: currently, there is no check for whether the disk is full, so make
-# # sure this value does not exceed the actual free space (otherwise darbup will
-# # fail with a nasty error when the disk is full).
+# # Note 2: darbup also stops short of filling up the disk (see Reserve below),
+# # removing old archives as needed, so it is fine for this value to exceed the
+# # free space.
 #
 # FullBackupsInterval=monthly
 # # Frequency with which to generate full (non-incremental) backups. Valid
 # # values:
 # # - monthly: creates a new full backup if the calendar month has changed
 # #   since the last time a full backup was made
+# # - weekly: creates a new full backup if the week (starting on Monday) has
+# #   changed since the time a full backup was made
 # # - daily: creates a new full backup if the day (00:00-23:59 period) has
 # #   changed since the time a full backup was made
 # # - always: creates a new full backup on every invocation of darbup
+# # - never: does not create full backups (except the first one)
+#
+# DifferentialBackupsInterval=never
+# # Frequency with which to generate differential backups. These are relative
+# # to the latest full backup, so restoring one only requires that full backup,
+# # rather than a chain of incremental backups; but they grow over time. Valid
+# # values are the same as for FullBackupsInterval. E.g. combine
+# # FullBackupsInterval=monthly with DifferentialBackupsInterval=weekly and
+# # IncrBackupsInterval=daily.
 #
 # IncrBackupsInterval=daily
 # # Frequency with which to generate incremental backups. These are incremental
-# # relative to the previous backup (which may itself be incremental). Valid
-# # values are the same as for FullBackupsInterval.
+# # relative to the previous backup (which may itself be incremental or
+# # differential). Valid values are the same as for FullBackupsInterval.
+#
+# ConsolidationInterval=never
+# # Frequency with which to consolidate archives, when no backup is due: the
+# # oldest full backup that only the incremental backup following it is
+# # relative to is merged with that incremental backup (using dar, without
+# # reading the files being backed up), into a new full backup which replaces
+# # the incremental one. The old full backup is then no longer needed by any
+# # other archive, so RemovalPolicy may choose it, and restoring a later
+# # incremental backup requires a shorter chain of archives. Valid values are
+# # the same as for FullBackupsInterval.
 #
 # RemovalPolicy=thinning
 # # When the disk is full -- as defined by the Capacity option -- we must delete
@@ -160,6 +334,104 @@ _DEFAULT_CONFIG = b'''\
 # # Note: we never delete archives that serve as reference for other
 # # (incremental) archives.
 #
+# PreCleaning=true
+# # Before starting a backup, predict the size of the new archive (as the
+# # largest of the latest three archives of the same type, full, incremental
+# # or differential), and remove old archives according to RemovalPolicy until
+# # there is room for it. This avoids removing archives while dar is running,
+# # which stalls it. If the prediction turns out too low, more archives are
+# # still removed as needed while the backup runs.
+#
+# PreCleaningMargin=10
+# # Percentage added to the predicted size, to allow for growth.
+#
+# CleanerWatermark=0
+# # If nonzero, then while a backup is being written, old archives are removed
+# # in the background whenever less than this amount of space is left, rather
+# # than only once the space has run out. Removing a large file can take a
+# # while, during which dar would otherwise be stalled. Same suffixes as for
+# # Capacity; a plain number is in bytes.
+#
+# Checksum=none
+# # If set to sha256 or blake2b, a checksum of each archive is computed while
+# # it is being written, and stored in a manifest file next to it (named like
+# # the archive, with ".manifest" appended). The manifest is in JSON format,
+# # and contains the checksum of the whole archive, as well as of each 64 MiB
+# # block of it. This allows verifying the archive without reading it twice.
+#
+# CatalogCache=false
+# # Whether to keep a copy of the catalog of each archive (as isolated by dar)
+# # under the "catalogs" subdirectory of StateDirectory (see below).
+# # Incremental backups then read the catalog of the previous archive from
+# # there, rather than from DestinationDir, which may be on a slow or sleeping
+# # disk. Catalogs are made while creating archives, or if missing, when first
+# # needed.
+#
+# CopyMethod=auto
+# # How the output of dar is written to the destination. 'splice' moves it
+# # within the kernel, which is fastest, but not supported by all filesystems
+# # (e.g. some FUSE filesystems such as sshfs). 'readwrite' copies it through a
+# # buffer, which works everywhere. 'auto' uses splice if the destination
+# # supports it, and readwrite otherwise. The throughput achieved is logged
+# # (at debug level) for each archive.
+#
+# PipeSize=0
+# # If nonzero, the capacity of the pipe from dar (the system default is
+# # usually 64k). A larger pipe lets dar keep going while writing to the
+# # destination briefly stalls. Note that unless darbup runs as root, this is
+# # limited by /proc/sys/fs/pipe-max-size (usually 1m). Same suffixes as for
+# # Capacity.
+#
+# RingBufferSize=0
+# # If nonzero, the size of an in-memory buffer between dar and the
+# # destination, which allows for longer stalls than PipeSize: dar's output is
+# # read into the buffer as fast as it arrives, and written out from it as fast
+# # as the destination allows. Statistics on how full the buffer got, and on how
+# # long either side had to wait, are logged for each archive. Same suffixes as
+# # for Capacity.
+#
+# WritebackInterval=0
+# # If nonzero, then each time this much has been written to an archive, the
+# # data is written out to disk, and dropped from the page cache. Otherwise,
+# # writing a large archive fills the page cache with data that nobody will
+# # read, evicting more useful data, and the kernel may end up writing it all
+# # out in one go. Something like 64m is a reasonable value. Either way, each
+# # archive is flushed to disk before it is considered complete. Same suffixes
+# # as for Capacity.
+#
+# Reserve=0
+# # Amount of space to leave free on the disk(s) holding DestinationDir and
+# # MirrorDirs. If writing an archive would use it up, old archives are
+# # removed, exactly as when Capacity is reached. Same suffixes as for Capacity.
+#
+# PreallocationSize=64m
+# # Space for archives is allocated ahead of writing them, in extents of this
+# # size, where the filesystem supports it. This reduces fragmentation, and
+# # means running out of space is noticed before a write fails. The free space
+# # is checked this often, too. Set to 0 to not preallocate. Same suffixes as
+# # for Capacity.
+#
+# BandwidthLimit=0
+# # If nonzero, the maximum rate, in bytes per second, at which archives are
+# # written. Same suffixes as for Capacity (e.g. 20m for 20 MiB/s).
+#
+# ThrottleOnPressure=0
+# # If nonzero, writing archives is slowed down whenever tasks on the system
+# # spend more than this percentage of time stalled waiting for I/O or memory,
+# # as reported in /proc/pressure, and sped up again once they no longer do.
+# # Something like 10 is a reasonable value.
+#
+# Nice=
+# # If set, the niceness (from -20 to 19) that darbup and dar run with while
+# # backing up, e.g. 17. Only root may lower the niceness (including back to
+# # what it was, afterwards).
+#
+# IOPriority=
+# # If set, the I/O scheduling class and priority that darbup and dar run with
+# # while backing up: idle, best-effort[:LEVEL] or realtime[:LEVEL], where LEVEL
+# # ranges from 0 (highest) to 7 (lowest), and defaults to 4. E.g. idle. See
+# # "man ionice"; note that not all I/O schedulers take this into account.
+#
 # IgnoreChangingFiles=false
 # # If dar detects that files are changing while it is reading them, those files
 # # within the archive may contain bad (incomplete) data. By default, we
@@ -170,11 +442,36 @@ _DEFAULT_CONFIG = b'''\
 # # part of the DarArguments configuration setting (see above) to change dar's
 # # behaviour (only sensible if IgnoreChangingFiles=true).
 #
+# DarFileMessages=all
+# # Which of the messages that dar prints about each file it processes (when
+# # made verbose by a -v option in DarArguments) to log: all of them, only
+# # their number (summary), or one in every N of them, plus their number (a
+# # number N). With millions of files, logging them all is slow. Warnings,
+# # errors, and messages about files that changed while being read are
+# # always logged in full.
+#
 # LogfileName=/home/fred/.darbup/logs/stuff.log
 # # Logfile name.
 #
 # LogsBackupCount=60
 # # How many back copies of logs to retain.
+#
+# MetricsDirectory=
+# # If set, then after each run that makes an archive (or consolidates some),
+# # measurements of it -- bytes written, throughput, latency of writes, time
+# # spent waiting for old archives to be removed, archives removed, dar's exit
+# # status -- are written to this directory, both in the textfile format of
+# # the Prometheus node_exporter (as darbup-<section>.prom) and as JSON (as
+# # darbup-<section>.json). Point node_exporter's textfile collector at it to
+# # graph and alert on them.
+#
+# StateDirectory=/home/fred/.darbup/state
+# # Directory where darbup keeps local state about this section, such as the
+# # time of the latest backup. This lets darbup decide that no backup is due
+# # without accessing DestinationDir (which may be on a disk that has spun
+# # down). Defaults to ~/.darbup/state, or /var/lib/darbup when run as root.
+# # It also holds a history of runs (history.sqlite), which 'darbup stats'
+# # reports on.
 '''
 
 def write_default_config(filename):
@@ -0,0 +1,177 @@
+# Copyright 2013 Carlo Teubner
+#
+# This file is part of darbup.
+#
+# darbup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# darbup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with darbup.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, os.path, sqlite3, time, logging
+
+from errors import exc_str
+from progress import format_size
+
+# Local record of every run of every section that made an archive (or
+# consolidated some), kept under StateDirectory, so that 'darbup stats' can
+# report on trends without touching the destination directories.
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    section TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    start REAL NOT NULL,
+    end REAL NOT NULL,
+    bytes INTEGER NOT NULL,
+    write_seconds REAL NOT NULL,
+    dar_status INTEGER,
+    success INTEGER NOT NULL,
+    total_size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_by_section ON runs (section, start);
+CREATE TABLE IF NOT EXISTS removals (
+    run INTEGER NOT NULL REFERENCES runs (id),
+    destination TEXT NOT NULL,
+    archive TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    policy TEXT NOT NULL
+);
+'''
+
+_DAY_SECS = 24 * 60 * 60
+
+_TREND_RUNS = 5  # compare the throughput of this many runs with the previous
+
+_GROWTH_DAYS = 30  # estimate the amount written per day over this period
+
+class RunHistory:
+    def __init__(self, state_dir):
+        os.makedirs(state_dir, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(state_dir, 'history.sqlite'))
+        self._db.executescript(_SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def record(self, metrics, total_size):
+        # Records the run measured by 'metrics' (a RunMetrics), after which
+        # the archives in the section's destination directory take up
+        # 'total_size' bytes.  The size and rate are those of the destination
+        # directory, not of any mirrors.
+        dest = metrics.destinations[0] if metrics.destinations else { }
+        with self._db:
+            run_id = self._db.execute(
+                'INSERT INTO runs (section, kind, start, end, bytes, '
+                'write_seconds, dar_status, success, total_size) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (metrics.section, metrics.kind, metrics.start_time,
+                 metrics.start_time + metrics.duration(),
+                 dest.get('bytes_written', 0), dest.get('write_seconds', 0.0),
+                 metrics.exit_status, int(metrics.succeeded()),
+                 total_size)).lastrowid
+            self._db.executemany(
+                'INSERT INTO removals VALUES (?, ?, ?, ?, ?)',
+                ((run_id, d['destination'], removed['archive'],
+                  removed['size'], d['removal_policy'])
+                 for d in metrics.destinations for removed in d['removed']))
+
+    def report(self, cfg, f):
+        # Writes a report on section 'cfg' to file 'f'.
+        runs = self._db.execute(
+            'SELECT kind, start, bytes, write_seconds, success, total_size '
+            'FROM runs WHERE section = ? ORDER BY start',
+            (cfg.name,)).fetchall()
+        f.write('Section {}: '.format(cfg.name))
+        if not runs:
+            f.write('no runs recorded\n')
+            return
+        num_failed = sum(1 for run in runs if not run[4])
+        f.write('{} since {}, {} of them failed\n'.format(
+            _plural(len(runs), 'run'), _format_time(runs[0][1]), num_failed))
+
+        for kind in ('full', 'incr', 'diff', 'consolidation'):
+            good = [ run for run in runs if run[0] == kind and run[4] ]
+            if not good:
+                continue
+            f.write('  {}: {}, latest {}'.format(
+                kind, _plural(len(good), 'successful run'),
+                format_size(good[-1][2])))
+            slope = _slope([ (run[1] / _DAY_SECS, run[2]) for run in good ])
+            if slope is not None:
+                f.write(', trend {}{}/day'.format('+' if slope >= 0 else '',
+                                                 format_size(slope)))
+            f.write('\n')
+            rates = [ run[2] / run[3] for run in good if run[3] > 0 ]
+            recent = rates[-_TREND_RUNS:]
+            earlier = rates[-2 * _TREND_RUNS:-_TREND_RUNS]
+            if recent:
+                f.write('    throughput {}/s (mean of latest {})'.format(
+                    format_size(_mean(recent)), len(recent)))
+                if earlier:
+                    f.write(', {:+.1f}% on the {} before'.format(
+                        100 * (_mean(recent) / _mean(earlier) - 1),
+                        len(earlier)))
+                f.write('\n')
+
+        now = time.time()
+        total_size = runs[-1][5]
+        f.write('  archives: {} of {} Capacity\n'.format(
+            format_size(total_size), format_size(cfg.capacity)))
+        since = now - _GROWTH_DAYS * _DAY_SECS
+        num_removed = self._db.execute(
+            'SELECT COUNT(*) FROM removals JOIN runs ON removals.run = runs.id '
+            'WHERE section = ? AND start >= ? AND destination = ?',
+            (cfg.name, since, os.path.normpath(cfg.dest_dir))).fetchone()[0]
+        recent = [ run for run in runs if run[1] >= since and run[4] ]
+        if num_removed:
+            f.write('  Capacity reached: {} archives removed in the last {} '
+                    'days\n'.format(num_removed, _GROWTH_DAYS))
+        elif recent:
+            days = max((now - recent[0][1]) / _DAY_SECS, 1)
+            per_day = sum(run[2] for run in recent) / days
+            f.write('  writing {}/day'.format(format_size(per_day)))
+            if per_day > 0:
+                f.write(', so Capacity will force removals in about {:.0f} '
+                        'days'.format(max(cfg.capacity - total_size, 0) /
+                                      per_day))
+            f.write('\n')
+
+def record(cfg, metrics, total_size):
+    try:
+        history = RunHistory(cfg.state_dir)
+        try:
+            history.record(metrics, total_size)
+        finally:
+            history.close()
+    except (OSError, sqlite3.Error) as e:
+        logging.warning('Failed to record run in history: {}'.format(
+            exc_str(e)))
+
+def _slope(points):
+    # Returns the least-squares slope through 'points', if there are enough.
+    if len(points) < 2:
+        return None
+    mean_x = _mean([ x for x, _ in points ])
+    mean_y = _mean([ y for _, y in points ])
+    var = sum((x - mean_x) ** 2 for x, _ in points)
+    if var == 0:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / var
+
+def _plural(n, noun):
+    return '{} {}{}'.format(n, noun, '' if n == 1 else 's')
+
+def _mean(values):
+    return sum(values) / len(values)
+
+def _format_time(t):
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(t))
@@ -0,0 +1,97 @@
+# Copyright 2013 Carlo Teubner
+#
+# This file is part of darbup.
+#
+# darbup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# darbup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with darbup.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, errno
+
+# Access to libc functions that the os module does not provide.  ctypes, and
+# finding libc, are comparatively slow (finding libc may run ldconfig), so
+# this is only done once such a function is first called.
+
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+FALLOC_FL_KEEP_SIZE = 1
+
+IOPRIO_CLASS_RT = 1
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_SHIFT = 13
+
+# glibc has no wrapper for ioprio_set(), nor for ioprio_get(), whose system
+# call number is always the next one
+_SYS_IOPRIO_SET = { 'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30,
+                    'riscv64': 30, 'armv7l': 314, 'ppc64le': 273,
+                    's390x': 282 }
+
+_libc = None
+
+def _load():
+    global _libc
+    if _libc is None:
+        import ctypes, ctypes.util
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _libc.splice.restype = ctypes.c_ssize_t
+        _libc.tee.restype = ctypes.c_ssize_t
+        _libc.sync_file_range.argtypes = [ ctypes.c_int, ctypes.c_int64,
+                                           ctypes.c_int64, ctypes.c_uint ]
+        _libc.fallocate.argtypes = [ ctypes.c_int, ctypes.c_int,
+                                     ctypes.c_int64, ctypes.c_int64 ]
+    return _libc
+
+def call(name, *args):
+    # Calls the libc function 'name', retrying if interrupted by a signal, and
+    # raising OSError if it fails.
+    import ctypes
+    func = getattr(_load(), name)
+    while True:
+        res = func(*args)
+        if res == -1:
+            errno_ = ctypes.get_errno()
+            if errno_ == errno.EINTR:
+                continue
+            raise OSError(errno_, os.strerror(errno_))
+        return res
+
+def sync_file_range(fd, offset, nbytes, flags):
+    call('sync_file_range', fd, offset, nbytes, flags)
+
+def fallocate(fd, mode, offset, length):
+    call('fallocate', fd, mode, offset, length)
+
+def ioprio_set(ioclass, level):
+    # Sets the I/O priority of the calling thread, and of the threads and
+    # processes it subsequently creates.
+    _ioprio_syscall(0, ioclass << _IOPRIO_CLASS_SHIFT | level)
+
+def ioprio_get():
+    # Returns the I/O priority of the calling thread, as a pair of its class
+    # and level, which can be passed to ioprio_set().
+    ioprio = _ioprio_syscall(1)
+    return (ioprio >> _IOPRIO_CLASS_SHIFT,
+            ioprio & ((1 << _IOPRIO_CLASS_SHIFT) - 1))
+
+def _ioprio_syscall(offset, *args):
+    import ctypes, platform
+    number = _SYS_IOPRIO_SET.get(platform.machine())
+    if number is None:
+        raise OSError(errno.ENOSYS, 'Unknown system call number for '
+                      'ioprio_set() on {}'.format(platform.machine()))
+    return call('syscall', ctypes.c_long(number + offset),
+                _IOPRIO_WHO_PROCESS, 0, *args)
@@ -0,0 +1,50 @@
+# Copyright 2013 Carlo Teubner
+#
+# This file is part of darbup.
+#
+# darbup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# darbup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with darbup.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, os.path, logging
+from contextlib import contextmanager
+
+from errors import BackupError
+
+@contextmanager
+def section_lock(cfg, wait=False):
+    # Holds a lock on section 'cfg' for the duration, so that it is not backed
+    # up by two instances at once.  If another instance holds the lock, waits
+    # for it if 'wait' is true, and fails otherwise.  The lock file is left in
+    # place afterwards: removing it would let a waiting instance lock the
+    # removed file, while a third one locks a newly created one.
+    os.makedirs(cfg.lock_dir, exist_ok=True)
+    path = os.path.join(cfg.lock_dir, cfg.name.replace('/', '_') + '.lock')
+    with open(path, 'a+') as lock_file:
+        lock_file.seek(0)
+        try:
+            os.lockf(lock_file.fileno(), os.F_TLOCK, 0)
+        except BlockingIOError:
+            other_pid = lock_file.read().rstrip()
+            if not wait:
+                raise BackupError('Section "{}" is already being backed up '
+                                  'by PID {}'.format(cfg.name, other_pid))
+            logging.info('Waiting for PID {} to finish with section "{}"'
+                         .format(other_pid, cfg.name))
+            os.lockf(lock_file.fileno(), os.F_LOCK, 0)
+        lock_file.truncate(0)
+        lock_file.write('{}\n'.format(os.getpid()))
+        lock_file.flush()
+        try:
+            yield
+        finally:
+            lock_file.truncate(0)
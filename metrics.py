@@ -0,0 +1,177 @@
+# Copyright 2013 Carlo Teubner
+#
+# This file is part of darbup.
+#
+# darbup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# darbup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with darbup.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, os.path, json, math, time, logging
+from collections import OrderedDict
+
+from errors import exc_str
+
+class LatencyHistogram:
+    # Counts latencies in logarithmic buckets, four per doubling from 1 µs
+    # up, so that percentiles can be estimated (to within about 20%) in
+    # constant space, however many calls are made.
+
+    _BUCKETS_PER_DOUBLING = 4
+    _NUM_BUCKETS = 30 * _BUCKETS_PER_DOUBLING  # up to about 18 minutes
+
+    def __init__(self):
+        self._counts = [ 0 ] * self._NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, secs):
+        self.count += 1
+        self.total += secs
+        micros = secs * 1e6
+        bucket = (int(math.log2(micros) * self._BUCKETS_PER_DOUBLING)
+                  if micros > 1 else 0)
+        self._counts[min(bucket, self._NUM_BUCKETS - 1)] += 1
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        # Returns the upper bound of the bucket holding the p-th percentile.
+        rank = math.ceil(self.count * p / 100)
+        seen = 0
+        for bucket, count in enumerate(self._counts):
+            seen += count
+            if count and seen >= rank:
+                return 2 ** ((bucket + 1) / self._BUCKETS_PER_DOUBLING) / 1e6
+        return 0.0
+
+class RunMetrics:
+    # Measurements of a run of a section that made an archive, written (if
+    # MetricsDirectory is set) both as a node_exporter textfile, and as a JSON
+    # document, each replaced atomically.
+
+    def __init__(self, section):
+        self.section = section
+        self.kind = None  # of backup, or 'consolidation'
+        self.start_time = time.time()
+        self._start = time.monotonic()
+        self.exit_status = None
+        self.destinations = [ ]
+
+    def record_write(self, status, outputs):
+        # Called by proc_write(); only the latest attempt counts.
+        self.exit_status = status
+        self.destinations = [ _output_metrics(output) for output in outputs ]
+
+    def duration(self):
+        return time.monotonic() - self._start
+
+    def succeeded(self):
+        return bool(self.destinations) and all(
+            dest['completed'] for dest in self.destinations)
+
+    def write(self, directory):
+        secs = self.duration()
+        success = self.succeeded()
+        doc = OrderedDict((
+            ('section', self.section),
+            ('kind', self.kind),
+            ('start_time', self.start_time),
+            ('duration_seconds', secs),
+            ('success', success),
+            ('dar_exit_status', self.exit_status),
+            ('destinations', self.destinations)))
+        lines = [ ]
+        section = [ ('section', self.section) ]
+        _metric(lines, 'last_run_start_timestamp_seconds',
+                'Start time of the latest run that made an archive.',
+                [ (section, self.start_time) ])
+        _metric(lines, 'last_run_duration_seconds',
+                'Wall time of the latest run that made an archive.',
+                [ (section, secs) ])
+        _metric(lines, 'last_run_success',
+                'Whether the latest run completed its archive everywhere.',
+                [ (section + [ ('kind', self.kind) ], int(success)) ])
+        if self.exit_status is not None:
+            _metric(lines, 'dar_exit_status',
+                    'Exit status of dar in the latest run (negative if it '
+                    'was killed by a signal).',
+                    [ (section, self.exit_status) ])
+        for name, help_text in _DESTINATION_METRICS:
+            _metric(lines, name, help_text,
+                    [ (section + [ ('destination', dest['destination']) ],
+                       dest[name]) for dest in self.destinations ])
+
+        basepath = os.path.join(directory,
+                                'darbup-' + self.section.replace('/', '_'))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            _write_atomically(basepath + '.prom', ''.join(lines))
+            _write_atomically(basepath + '.json',
+                              json.dumps(doc, indent=1) + '\n')
+        except OSError as e:
+            logging.warning('Failed to write metrics to {}: {}'.format(
+                directory, exc_str(e)))
+
+_DESTINATION_METRICS = (
+    ('bytes_written', 'Bytes written by the latest run.'),
+    ('write_seconds', 'Time taken to write the archive.'),
+    ('write_bytes_per_second', 'Mean rate at which the archive was written.'),
+    ('copy_calls', 'Number of splice() (or read() and write()) calls made.'),
+    ('copy_latency_mean_seconds', 'Mean duration of a copy call.'),
+    ('copy_latency_p99_seconds',
+     '99th percentile of the duration of a copy call.'),
+    ('cleaner_blocked_seconds',
+     'Time spent waiting for old archives to be removed.'),
+    ('removed_bytes', 'Size of the old archives removed by the latest run.'),
+    ('removed_archives', 'Number of old archives removed by the latest run.'),
+    ('completed', 'Whether the archive was completed.'))
+
+def _output_metrics(output):
+    secs = output.secs
+    return OrderedDict((
+        ('destination', os.path.dirname(output.filename)),
+        ('bytes_written', output.num_written),
+        ('write_seconds', secs),
+        ('write_bytes_per_second', output.num_written / secs if secs else 0.0),
+        ('copy_calls', output.latencies.count),
+        ('copy_latency_mean_seconds', output.latencies.mean()),
+        ('copy_latency_p99_seconds', output.latencies.percentile(99)),
+        ('cleaner_blocked_seconds', output.cleaner_secs),
+        ('removed_bytes', sum(size for _, size in output.cleaner.removed)),
+        ('removed_archives', len(output.cleaner.removed)),
+        ('removed', [ OrderedDict((('archive', basename), ('size', size)))
+                      for basename, size in output.cleaner.removed ]),
+        ('removal_policy', output.cleaner.rmpolicy.name),
+        ('completed', int(output.completed))))
+
+def _metric(lines, name, help_text, samples):
+    # Appends a gauge in the Prometheus text format to 'lines'.
+    if not samples:
+        return
+    name = 'darbup_' + name
+    lines.append('# HELP {} {}\n'.format(name, help_text))
+    lines.append('# TYPE {} gauge\n'.format(name))
+    for labels, value in samples:
+        lines.append('{}{{{}}} {!r}\n'.format(name, ','.join(
+            '{}="{}"'.format(label, _escape(label_value))
+            for label, label_value in labels), value))
+
+def _escape(label_value):
+    return (label_value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+def _write_atomically(path, text):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        f.write(text)
+    os.replace(temp_path, path)
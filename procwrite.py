@@ -15,99 +15,582 @@
 # You should have received a copy of the GNU General Public License
 # along with darbup.  If not, see <http://www.gnu.org/licenses/>.
 
-from errors import exc_str
+from errors import BackupError, NoRemovalCandidatesError, exc_str
 
-import subprocess, signal, logging, threading, io, os
-from splice import splice
+import subprocess, signal, logging, threading, os, fcntl, errno, time, re
+import codecs, queue
+from splice import splice, tee
+import libc
+from ringbuffer import RingBuffer, set_pipe_size, F_GETPIPE_SZ, F_SETPIPE_SZ
+from metrics import LatencyHistogram
+import spans
 
-def proc_write(command, filename, limit, cleaner, good_exit_codes=(0,)):
-    logging.debug('Starting process {}, writing to {}, max {} bytes'
-                  .format(command, filename, limit))
-    success = False
-    outfile = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+_DEFAULT_EXTENT = 64 << 20
+
+class SpliceCopier:
+    # Moves data from a pipe to a file within the kernel.
+    name = 'splice'
+
+    def __call__(self, fd_in, fd_out, length):
+        return splice(fd_in, fd_out, length)
+
+class ReadWriteCopier:
+    # Copies data from a pipe to a file via a large buffer.  For destinations
+    # that do not support splice(), such as many FUSE filesystems.
+    name = 'read/write'
+
+    _BUFFER_SIZE = 1 << 20
+
+    def __init__(self):
+        self._buffer = memoryview(bytearray(self._BUFFER_SIZE))
+
+    def __call__(self, fd_in, fd_out, length):
+        num_read = os.readv(fd_in, [ self._buffer[:length] ])
+        num_written = 0
+        while num_written < num_read:
+            num_written += os.write(fd_out,
+                                    self._buffer[num_written:num_read])
+        return num_read
+
+class AutoCopier:
+    # Uses splice() if the destination supports it, as found out by the first
+    # call, and otherwise falls back to read()/write().  No data is consumed
+    # from the pipe if splice() fails because of the destination.
+    def __init__(self):
+        self._copier = SpliceCopier()
+        self._probed = False
+
+    @property
+    def name(self):
+        return self._copier.name
+
+    def __call__(self, fd_in, fd_out, length):
+        if self._probed:
+            return self._copier(fd_in, fd_out, length)
+        try:
+            num_written = self._copier(fd_in, fd_out, length)
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP, errno.ENOSYS):
+                raise
+            logging.info('Destination does not support splice() ({}); '
+                         'using read() and write() instead'.format(exc_str(e)))
+            self._copier = ReadWriteCopier()
+            num_written = self._copier(fd_in, fd_out, length)
+        self._probed = True
+        return num_written
+
+def copier_by_name(name):
+    if name == 'auto': return AutoCopier()
+    elif name == 'splice': return SpliceCopier()
+    elif name == 'readwrite': return ReadWriteCopier()
+    raise BackupError('Invalid copy method: "{}"'.format(name))
+
+class Output:
+    # A file that the output of the process is written to, with its own space
+    # limit and cleaner (which is called to free up more space once the limit
+    # is reached).  If writing to it fails, 'error' is set, the other outputs
+    # carry on, and the file is removed.
+    #
+    # The limit is the lesser of 'capacity' (the number of bytes that may be
+    # written within the configured Capacity) and, unless 'reserve' is None,
+    # the free space on disk minus 'reserve'.  The latter is checked (and, if
+    # possible, allocated using fallocate()) in extents of 'extent' bytes, so
+    # running out of disk space is noticed before writing fails.
+
+    def __init__(self, filename, capacity, cleaner, copy_method='auto',
+                 writeback=0, reserve=None, extent=_DEFAULT_EXTENT):
+        self.filename = filename
+        self.capacity = capacity
+        self.cleaner = cleaner
+        self.copier = copier_by_name(copy_method)
+        self.writeback = writeback
+        self._writeback_prev = self._writeback_start = 0
+        self.reserve = reserve
+        self.extent = extent
+        self._preallocate = extent > 0
+        self._checked = 0 if reserve is not None else None
+        self.num_written = 0
+        self.error = None
+        self.completed = False
+        self.fd = None
+        self.secs = 0.0
+        self.latencies = LatencyHistogram()  # of copy calls
+        self.cleaner_secs = 0.0  # blocked waiting for the cleaner
+
+    @property
+    def limit(self):
+        if self._checked is None:
+            return self.capacity
+        return min(self.capacity, self._checked - self.num_written)
+
+    def make_room(self):
+        self.capacity += self.cleaner.progress(self.capacity)
+        while self.capacity <= 0:
+            logging.info('Ran out of space while writing {}: {} bytes left'
+                         .format(self.filename, self.capacity))
+            self._clean()
+            logging.debug('After cleanup, new capacity is {} bytes'
+                          .format(self.capacity))
+        if self._checked is not None and self.num_written >= self._checked:
+            self._check_disk()
+
+    def _check_disk(self):
+        # Makes sure there is space on disk for (up to) the next extent, and
+        # allocates it.
+        while True:
+            st = os.fstatvfs(self.fd)
+            length = min(self.extent or _DEFAULT_EXTENT, self.capacity,
+                         st.f_bavail * st.f_frsize - self.reserve)
+            if length > 0 and self._preallocate:
+                try:
+                    libc.fallocate(self.fd, libc.FALLOC_FL_KEEP_SIZE,
+                                   self.num_written, length)
+                except OSError as e:
+                    if e.errno == errno.ENOSPC:
+                        length = 0
+                    elif e.errno in (errno.EOPNOTSUPP, errno.ENOSYS):
+                        logging.debug('Cannot preallocate space for {}: {}'
+                                      .format(self.filename, exc_str(e)))
+                        self._preallocate = False
+                    else:
+                        raise
+            if length > 0:
+                self._checked = self.num_written + length
+                return
+            logging.info('Ran out of disk space while writing {}: {} bytes '
+                         'free, of which {} are to be kept free'.format(
+                             self.filename, st.f_bavail * st.f_frsize,
+                             self.reserve))
+            self._clean()
+
+    def _clean(self):
+        start = time.monotonic()
+        try:
+            self.capacity += self.cleaner()
+        finally:
+            self.cleaner_secs += time.monotonic() - start
+
+    def copy(self, fd_in, length):
+        # Copies up to 'length' bytes from the pipe 'fd_in'; returns the number
+        # of bytes copied, which is 0 at EOF.
+        start = time.monotonic()
+        num_written = self.copier(fd_in, self.fd, length)
+        self.latencies.add(time.monotonic() - start)
+        self.wrote(num_written)
+        return num_written
+
+    def copy_fully(self, fd_in, length):
+        # Copies exactly 'length' bytes from the pipe 'fd_in'; returns the
+        # number of calls this took.
+        num_calls = 0
+        while length > 0:
+            num_calls += 1
+            num_written = self.copy(fd_in, length)
+            if num_written == 0:
+                raise OSError('Unexpected end of data')
+            length -= num_written
+        return num_calls
+
+    def wrote(self, num_bytes):
+        self.num_written += num_bytes
+        self.capacity -= num_bytes
+        if (self.writeback and
+                self.num_written - self._writeback_start >= self.writeback):
+            try:
+                self._write_back()
+            except OSError as e:
+                logging.warning('Paced writeback of {} failed, disabling it: '
+                                '{}'.format(self.filename, exc_str(e)))
+                self.writeback = 0
+
+    def sync(self):
+        # Makes sure all data written has reached the disk.
+        try:
+            if self._preallocate:
+                # free up space allocated beyond the end
+                os.ftruncate(self.fd, self.num_written)
+            os.fsync(self.fd)
+            if self.writeback:
+                os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError as e:
+            self.fail(e)
+
+    def _write_back(self):
+        # Starts writeback of the data written since the last call; then waits
+        # for the writeback started by the previous call, and drops that data
+        # from the page cache, as nobody is going to read it.  This limits the
+        # dirty (and cached) data due to this output to about twice the
+        # writeback interval, and avoids a writeback storm at the end.
+        start, end = self._writeback_start, self.num_written
+        libc.sync_file_range(self.fd, start, end - start,
+                             libc.SYNC_FILE_RANGE_WRITE)
+        prev = self._writeback_prev
+        if prev < start:
+            libc.sync_file_range(self.fd, prev, start - prev,
+                                 libc.SYNC_FILE_RANGE_WAIT_BEFORE |
+                                 libc.SYNC_FILE_RANGE_WRITE |
+                                 libc.SYNC_FILE_RANGE_WAIT_AFTER)
+            os.posix_fadvise(self.fd, prev, start - prev,
+                             os.POSIX_FADV_DONTNEED)
+        self._writeback_prev, self._writeback_start = start, end
+
+    def fail(self, error):
+        logging.error('Failed to write {}: {}'.format(self.filename,
+                                                     exc_str(error)))
+        self.error = error
+
+    def _open(self):
+        self.fd = os.open(self.filename, os.O_WRONLY | os.O_TRUNC)
+        self._start_time = time.monotonic()
+
+    def _close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            self.secs = time.monotonic() - self._start_time
+            logging.debug('Wrote {} bytes to {} in {:.1f} seconds '
+                          '({:.1f} MiB/s) using {}'.format(
+                              self.num_written, self.filename, self.secs,
+                              self.num_written / 2**20 /
+                              max(self.secs, 1e-6), self.copier.name))
+        if not self.completed:
+            os.remove(self.filename)
+
+def proc_write(command, outputs, good_exit_codes=(0,), checksummer=None,
+               pipe_size=0, buffer_size=0, throttle=None, metrics=None,
+               progress=None, file_messages=1, preexec_fn=None):
+    # Runs 'command', writing its standard output to each of 'outputs' (and
+    # to 'checksummer', if given).  Returns a description of its exit status;
+    # the outputs that were written successfully are marked 'completed', and
+    # all others have been removed.  If nonzero, 'pipe_size' is the capacity
+    # to use for the pipe from 'command', and 'buffer_size' that of a ring
+    # buffer to add between the pipe and the outputs.  'throttle', if given,
+    # is called with the size of each chunk written, and may sleep.
+    # 'metrics', if given, records the exit status and the outputs'
+    # statistics, even if an exception is raised.  'progress', if given,
+    # publishes the progress of the first output while it is being written.
+    # Of the per-file messages that 'command' prints to its standard error,
+    # every 'file_messages'th one is logged (none if it is 0); see
+    # _LoggerThread.  'preexec_fn', if given, is called in the child process
+    # just before 'command' is executed.
+    logging.debug('Starting process {}, writing to {}'.format(
+        command, ', '.join('{} (max {} bytes)'.format(o.filename, o.capacity)
+                           for o in outputs)))
+    status = None
     stderr_logger = None
     try:
-        stderr_logger = _LoggerThread()
-        status, numbytes = \
-            _proc_write(command, outfile, limit, cleaner, stderr_logger)
+        for output in outputs:
+            output._open()
+        if progress:
+            progress.start(outputs[0])
+        if checksummer:
+            checksummer.start()
+        stderr_logger = _LoggerThread(file_messages)
+        status = _proc_write(command, outputs, checksummer, stderr_logger,
+                             pipe_size, buffer_size, throttle, preexec_fn)
+        if checksummer:
+            with spans.span('finish checksum'):
+                checksummer.finish()
         if status in good_exit_codes:
-            success = True
+            with spans.span('sync'):
+                for output in outputs:
+                    if output.error is None:
+                        output.sync()
+                    output.completed = output.error is None
     finally:
+        if progress:
+            progress.stop()
+        for output in outputs:
+            output.cleaner.close()
+        if checksummer:
+            checksummer.finish()
         if stderr_logger and stderr_logger.is_started:
-            stderr_logger.join()
+            with spans.span('join stderr logger'):
+                stderr_logger.join()
             logging.debug('Joined subprocess logger thread')
-        os.close(outfile)
-        if not success:
-            os.remove(filename)
-    return _interpret_exit_status(status), numbytes
+        with spans.span('close'):
+            for output in outputs:
+                output._close()
+        if metrics:
+            metrics.record_write(status, outputs)
+    return _interpret_exit_status(status)
 
 _KILL_TIMEOUT_SECS = 3
 
-def _proc_write(command, outfile, limit, cleaner, stderr_logger):
-    proc = subprocess.Popen(command, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
+_MAX_CHUNK = 2**30  # avoid int overflows
+
+def _proc_write(command, outputs, checksummer, stderr_logger, pipe_size,
+                buffer_size, throttle, preexec_fn):
+    with spans.span('start process'):
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                preexec_fn=preexec_fn)
     proc_desc = '{} (pid {})'.format(
         command if isinstance(command, str) else command[0], proc.pid)
-    proc_stdout = proc.stdout.fileno()
+    src = proc.stdout.fileno()
     stderr_logger.startLogging(proc.stderr, proc_desc)
-    total_num_written = 0
-    num_splice_calls = 0
+    buffer = None
     try:
-        while True:
-            if limit <= 0:
-                logging.debug('Ran out of space: {} bytes left'.format(limit))
-                limit += cleaner()
-                logging.debug('After cleanup, new capacity is {} bytes'
-                              .format(limit))
+        set_pipe_size(src, pipe_size)
+        if buffer_size:
+            buffer = RingBuffer(src, buffer_size, pipe_size)
+            buffer.start()
+            src = buffer.fd
+        with spans.span('copy'):
+            if len(outputs) == 1 and not checksummer:
+                num_calls = _copy(src, outputs[0], throttle)
+            else:
+                num_calls = _copy_teed(src, outputs, checksummer, throttle)
+        if all(output.error for output in outputs):
+            status = None
+            logging.info('Waiting for {} to exit'.format(proc_desc))
             try:
-                num_splice_calls += 1
-                eff_limit = min(limit, 2**30)  # avoid int overflows
-                num_written = splice(proc_stdout, outfile, eff_limit)
-            except OSError as e:
-                logging.error(exc_str(e))
-                status = None
-                logging.info('Waiting for {} to exit'.format(proc_desc))
-                try:
-                    status = proc.wait(_KILL_TIMEOUT_SECS)
-                    logging.debug('{} exited with status {}'.format(proc_desc,
-                                                                    status))
-                except subprocess.TimeoutExpired:
-                    logging.warning('{} timed out: terminating'.format(
-                        proc_desc))
-                    _kill(proc, proc_desc)
-                return status, total_num_written
-            total_num_written += num_written
-            limit -= num_written
-            if num_written == 0:
-                logging.debug('Finished: wrote {} bytes in {} splice() '
-                              'calls; waiting for {} to exit'.format(
-                                  total_num_written, num_splice_calls,
-                                  proc_desc))
-                status = proc.wait()
+                status = proc.wait(_KILL_TIMEOUT_SECS)
                 logging.debug('{} exited with status {}'.format(proc_desc,
                                                                 status))
-                return status, total_num_written
+            except subprocess.TimeoutExpired:
+                logging.warning('{} timed out: terminating'.format(
+                    proc_desc))
+                _kill(proc, proc_desc)
+            return status
+        if buffer:
+            buffer.finish()
+        logging.debug('Finished: wrote {} bytes in {} calls; '
+                      'waiting for {} to exit'.format(
+                          max(output.num_written for output in outputs),
+                          num_calls, proc_desc))
+        if throttle:
+            logging.debug('Throttling slept for {:.1f} seconds, and backed off '
+                          '{} times due to pressure'.format(
+                              throttle.slept, throttle.num_backoffs))
+        with spans.span('wait for process'):
+            status = proc.wait()
+        logging.debug('{} exited with status {}'.format(proc_desc, status))
+        return status
     except:
         logging.warning('Terminating {}'.format(proc_desc))
         _kill(proc, proc_desc)
         raise
+    finally:
+        if buffer:
+            buffer.close()
+
+def _copy(src, output, throttle):
+    # Copies from 'src' to 'output' until EOF, or until writing fails.
+    # Returns the number of copy calls made.
+    num_calls = 0
+    while True:
+        output.make_room()
+        try:
+            num_calls += 1
+            num_written = output.copy(src, min(output.limit, _MAX_CHUNK))
+        except OSError as e:
+            output.fail(e)
+            return num_calls
+        if num_written == 0:
+            return num_calls
+        if throttle:
+            throttle(num_written)
+
+def _copy_teed(src, outputs, checksummer, throttle):
+    # Like _copy(), but for several outputs, and/or a checksummer.  Each chunk
+    # of data is duplicated from 'src' using tee(), without copying it: first
+    # to the checksummer, which determines the size of the chunk, as its pipe
+    # may be partly full; then to a pipe per output, unless there is only one.
+    # Only then is the chunk consumed from 'src': by splicing it to the single
+    # output, or else to /dev/null, followed by copying it from each output's
+    # pipe to its file.  An output that fails is dropped, without affecting
+    # the others.
+    pipe_size = fcntl.fcntl(src, F_GETPIPE_SZ)
+    pipes = { }
+    devnull = None
+    num_calls = 0
+    try:
+        if len(outputs) > 1:
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            for output in outputs:
+                pipes[output] = os.pipe()
+                fcntl.fcntl(pipes[output][1], F_SETPIPE_SZ, pipe_size)
+        while True:
+            live = _make_room(outputs)
+            if not live:
+                return num_calls
+            length = min([ pipe_size ] + [ o.limit for o in live ])
+            teed = live if len(outputs) > 1 else [ ]
+            if checksummer:
+                num_calls += 1
+                length = tee(src, checksummer.fd, length)
+            elif teed:
+                num_calls += 1
+                length = tee(src, pipes[teed[0]][1], length)
+                teed = teed[1:]
+            if length == 0:
+                return num_calls
+            for output in teed:
+                num_calls += 1
+                num_teed = tee(src, pipes[output][1], length)
+                if num_teed != length:
+                    output.fail(BackupError('Could only duplicate {} of {} '
+                                            'bytes'.format(num_teed, length)))
+            if not pipes:
+                try:
+                    num_calls += live[0].copy_fully(src, length)
+                except OSError as e:
+                    live[0].fail(e)
+            else:
+                num_calls += _splice_fully(src, devnull, length)
+                for output in live:
+                    if output.error: continue
+                    try:
+                        num_calls += output.copy_fully(pipes[output][0],
+                                                       length)
+                    except OSError as e:
+                        output.fail(e)
+            if throttle:
+                throttle(length)
+    finally:
+        if devnull is not None:
+            os.close(devnull)
+        for pipe in pipes.values():
+            os.close(pipe[0])
+            os.close(pipe[1])
+
+def _make_room(outputs):
+    # Returns the outputs that are still live, after making sure they all have
+    # space left.  If the cleaner of the only live output fails, its exception
+    # is propagated, as is a NoRemovalCandidatesError from the first output's
+    # cleaner (so that the caller can retry); other outputs just fail.
+    for output in outputs:
+        if output.error: continue
+        try:
+            output.make_room()
+        except NoRemovalCandidatesError as e:
+            if output is outputs[0]:
+                raise
+            output.fail(e)
+        except BackupError as e:
+            if sum(1 for o in outputs if not o.error) == 1:
+                raise
+            output.fail(e)
+    return [ output for output in outputs if not output.error ]
+
+def _splice_fully(fd_in, fd_out, length):
+    num_calls = 0
+    while length > 0:
+        num_calls += 1
+        num_written = splice(fd_in, fd_out, length)
+        if num_written == 0:
+            raise OSError('Unexpected end of data')
+        length -= num_written
+    return num_calls
+
+# Per-file messages printed by dar when verbose (see the -v options of dar).
+_FILE_MESSAGE_RE = re.compile(
+    r'(Adding (file|folder|Hard link) to archive|Recursing into directory|'
+    r'(Finished )?Inspecting directory|Skipping file|'
+    r'Saving (Extended|Filesystem Specific) Attributes for)\b')
+
+# Messages that are always logged, such as those about files that changed
+# while being read.  Of a per-file message, only dar's own words (as matched
+# by _FILE_MESSAGE_RE) are checked, not the path, lest a file named e.g.
+# error.c make its message look important.
+_IMPORTANT_RE = re.compile(
+    r'warning|error|fail|cannot|could not|changed|modified|retry|abort',
+    re.IGNORECASE)
+
+_READ_SIZE = 1 << 16
+
+_MAX_BACKLOG = 256  # chunks read but not logged yet, beyond which the
+                    # reader waits
 
 class _LoggerThread(threading.Thread):
-    def __init__(self):
-        threading.Thread.__init__(self)
+    # Logs what the process prints to its standard error.  This thread only
+    # reads it, in large chunks, and queues them, so that the process is not
+    # held up by logging, however much it prints.  A second thread logs the
+    # queued lines in batches, one log record per line.  Of the per-file
+    # messages, only every 'file_messages'th one is logged (none if 0); at the
+    # end, their number is logged.  Other messages are always logged.
+
+    def __init__(self, file_messages=1):
+        threading.Thread.__init__(self, name='stderr reader')
         self.is_started = False
+        self._file_messages = file_messages
+        self._queue = queue.Queue(_MAX_BACKLOG)
+        self._writer = threading.Thread(target=self._write,
+                                        name='stderr logger')
 
     def startLogging(self, f, prefix):
         self.f = f
         self.prefix = prefix
         self.is_started = True
+        self._writer.start()
         self.start()
 
     def run(self):
-        for line in io.TextIOWrapper(self.f, errors='replace'):
-            logging.info('{}: {}'.format(self.prefix, line.rstrip('\r\n')))
+        try:
+            fd = self.f.fileno()
+            while True:
+                chunk = os.read(fd, _READ_SIZE)
+                if not chunk:
+                    break
+                self._queue.put(chunk)
+        finally:
+            self._queue.put(None)
+
+    def join(self):
+        threading.Thread.join(self)
+        self._writer.join()
+
+    def _write(self):
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        partial = ''
+        self._num_file_messages = self._num_logged = 0
+        done = False
+        while not done:
+            chunks = [ self._queue.get() ]
+            for i in range(self._queue.qsize()):
+                chunks.append(self._queue.get())
+            if chunks[-1] is None:
+                done = True
+                chunks.pop()
+            text = partial + decoder.decode(b''.join(chunks), final=done)
+            lines = text.split('\n')
+            partial = lines.pop()
+            if done and partial:
+                lines.append(partial)
+            self._log_lines(lines)
+        if self._num_logged < self._num_file_messages:
+            logging.info('{}: logged {} of {} per-file messages'.format(
+                self.prefix, self._num_logged, self._num_file_messages))
         logging.debug('Exiting logger thread for {}'.format(self.prefix))
 
+    def _log_lines(self, lines):
+        # Logs each line as a record of its own.  The records are created
+        # directly, skipping logging.info()'s search of the stack for its
+        # caller, and all but the last are marked 'batched', which tells
+        # handlers that more records are to follow at once, so there is no
+        # need to flush yet (see LogFileHandler in __main__).
+        logger = logging.getLogger()
+        enabled = logger.isEnabledFor(logging.INFO)
+        records = [ ]
+        for line in lines:
+            line = line.rstrip('\r')
+            m = _FILE_MESSAGE_RE.match(line)
+            if m and not _IMPORTANT_RE.search(m.group()):
+                self._num_file_messages += 1
+                if (not self._file_messages or
+                        self._num_file_messages % self._file_messages):
+                    continue
+                self._num_logged += 1
+            if not enabled: continue
+            records.append(logger.makeRecord(
+                logger.name, logging.INFO, __file__, 0, '%s: %s',
+                (self.prefix, line), None))
+        for record in records[:-1]:
+            record.batched = True
+        for record in records:
+            logger.handle(record)
+
 def _kill(proc, proc_desc):
     proc.terminate()
     logging.info('Requested {} to exit'.format(proc_desc))
@@ -0,0 +1,118 @@
+# Copyright 2013 Carlo Teubner
+#
+# This file is part of darbup.
+#
+# darbup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# darbup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with darbup.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, os.path, json, threading, time, logging
+from collections import deque
+
+from errors import exc_str
+
+_RATE_WINDOW_SECS = 10  # the current rate is the mean over this period
+
+class Progress:
+    # Publishes the progress of writing an archive to a JSON status file in
+    # the lock directory, for 'darbup status' to read.  The file is updated
+    # every 'interval' seconds by a thread of its own, which only reads the
+    # number of bytes written so far, so the writer never waits for it; and
+    # it is replaced atomically, so readers never see a partial update.  It
+    # is removed when writing ends.
+
+    def __init__(self, cfg, kind, expected_size, interval=1.0):
+        self._path = status_path(cfg)
+        self._status = { 'section': cfg.name, 'kind': kind, 'pid': os.getpid(),
+                         'expected_size': expected_size }
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self, output):
+        self._output = output
+        self._status['start_time'] = time.time()
+        self._status['destination'] = output.filename
+        self._samples = deque()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='progress')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                self._update()
+            except OSError as e:
+                logging.warning('Failed to write progress to {}, giving up: '
+                                '{}'.format(self._path, exc_str(e)))
+                return
+
+    def _update(self):
+        now = time.monotonic()
+        num_written = self._output.num_written
+        samples = self._samples
+        samples.append((now, num_written))
+        while now - samples[0][0] > _RATE_WINDOW_SECS:
+            samples.popleft()
+        start, start_written = samples[0]
+        rate = (num_written - start_written) / (now - start) \
+               if now > start else 0.0
+        expected_size = self._status['expected_size']
+        eta = None
+        if expected_size and rate > 0 and num_written < expected_size:
+            eta = time.time() + (expected_size - num_written) / rate
+        self._status.update(update_time=time.time(), bytes_written=num_written,
+                            rate=rate, eta=eta)
+        temp_path = self._path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self._status, f)
+        os.replace(temp_path, self._path)
+
+def status_path(cfg):
+    return os.path.join(cfg.lock_dir, cfg.name.replace('/', '_') + '.progress')
+
+def read_status(cfg):
+    # Returns the status published by the process writing an archive of
+    # section 'cfg', or None if no such process is running.
+    try:
+        with open(status_path(cfg)) as f:
+            status = json.load(f)
+    except (OSError, ValueError):
+        return None
+    try:
+        os.kill(status['pid'], 0)
+    except ProcessLookupError:
+        return None  # left behind by a process that was killed
+    except PermissionError:
+        pass
+    return status
+
+def format_size(num_bytes):
+    for unit in ('bytes', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if abs(num_bytes) < 1024 or unit == 'TiB':
+            break
+        num_bytes /= 1024
+    if unit == 'bytes':
+        return '{:.0f} bytes'.format(num_bytes)
+    return '{:.1f} {}'.format(num_bytes, unit)
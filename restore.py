@@ -0,0 +1,232 @@
+# Copyright 2013 Carlo Teubner
+#
+# This file is part of darbup.
+#
+# darbup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# darbup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with darbup.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, os.path, sqlite3, subprocess, tempfile, logging
+from xml.etree import ElementTree
+
+from errors import BackupError, exc_str
+
+# What an archive holds of each file: its data, a record that it is unchanged
+# since the reference archive, or a record that it was removed since then.
+SAVED, UNCHANGED, REMOVED = 'saved', 'unchanged', 'removed'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS archives (
+    id INTEGER PRIMARY KEY,
+    basename TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    archive INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    status TEXT NOT NULL,
+    PRIMARY KEY (archive, path)
+) WITHOUT ROWID;
+'''
+
+def restore(cfg, arcset, catalogs, path, at, into):
+    # Restores 'path' (relative to the root of the archives) as it was at time
+    # 'at' into directory 'into', extracting each file from the one archive
+    # that holds its data at that time.  Only those archives are read.
+    latest = None
+    for arc in arcset:
+        if arc.timestamp <= at and not arc.is_current:
+            latest = arc
+    if not latest:
+        raise BackupError('No archive was made by {:%Y-%m-%d %H:%M}'.format(at))
+    chain = [ ]
+    arc = latest
+    while arc:
+        chain.append(arc)
+        arc = arc.reference()
+
+    index = FileIndex(cfg)
+    try:
+        index.update(arcset, catalogs)
+        sources = index.locate(chain, path)
+    finally:
+        index.close()
+    if not sources:
+        raise BackupError('"{}" is not in {}'.format(path, latest.path()))
+
+    by_archive = { }
+    for file_path, arc in sources.items():
+        by_archive.setdefault(arc, [ ]).append(file_path)
+    logging.info('Restoring {} files from {} of {} archives, as of {}'.format(
+        len(sources), len(by_archive), len(chain), latest.path()))
+    for arc in reversed(chain):
+        if arc in by_archive:
+            extract(arc, by_archive[arc], into)
+
+def extract(arc, paths, into):
+    logging.info('Extracting {} files from {}'.format(len(paths), arc.path()))
+    with tempfile.NamedTemporaryFile('w', prefix='darbup-',
+                                     suffix='.list') as listing:
+        for path in sorted(paths):
+            listing.write(path + '\n')
+        listing.flush()
+        proc = subprocess.Popen(
+            [ '/usr/bin/dar', '-x', arc.basepath(), '-R', into,
+              '-[', listing.name, '-w', '-Q' ],
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, universal_newlines=True)
+        for line in proc.stdout:
+            logging.info('dar: ' + line.rstrip('\n'))
+        status = proc.wait()
+    if status != 0:
+        raise BackupError('dar exited with status {}'.format(status))
+
+def archive_path(cfg, path):
+    # Returns 'path' relative to the root of the archives of section 'cfg',
+    # which is given to dar by its -R option; an absolute 'path' must be
+    # beneath that.  The root itself is ''.
+    if os.path.isabs(path):
+        root = _fs_root(cfg.dar_args)
+        if root is None:
+            raise BackupError('Cannot tell where "{}" is in the archives: '
+                              'no -R option in DarArguments'.format(path))
+        rel_path = os.path.relpath(path, root)
+        if rel_path == os.pardir or rel_path.startswith(os.pardir + os.sep):
+            raise BackupError('"{}" is not beneath {}, the root of the '
+                              'archives'.format(path, root))
+        path = rel_path
+    path = os.path.normpath(path)
+    return '' if path == os.curdir else path
+
+def _fs_root(dar_args):
+    for i, arg in enumerate(dar_args):
+        if arg in ('-R', '--fs-root') and i + 1 < len(dar_args):
+            return dar_args[i + 1]
+        if arg.startswith('--fs-root='):
+            return arg[10:]
+        if arg.startswith('-R') and len(arg) > 2:
+            return arg[2:]
+    return None
+
+class FileIndex:
+    # SQLite database (under StateDirectory) recording which files each
+    # archive of a section holds, as listed by dar.  It is brought up to date
+    # with the archives on every use: archives not seen before are listed
+    # (from their isolated catalogs, if available), and those that have gone
+    # are dropped.
+
+    def __init__(self, cfg):
+        index_dir = os.path.join(cfg.state_dir, 'files')
+        os.makedirs(index_dir, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(
+            index_dir, cfg.name.replace('/', '_') + '.sqlite'))
+        self._db.executescript(_SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def update(self, arcset, catalogs):
+        known = dict(self._db.execute('SELECT basename, id FROM archives'))
+        basenames = set(arc.basename() for arc in arcset
+                        if not arc.is_current)
+        for basename, archive_id in known.items():
+            if basename not in basenames:
+                logging.debug('Dropping {} from file index'.format(basename))
+                with self._db:
+                    self._db.execute('DELETE FROM files WHERE archive = ?',
+                                     (archive_id,))
+                    self._db.execute('DELETE FROM archives WHERE id = ?',
+                                     (archive_id,))
+        for arc in arcset:
+            if not arc.is_current and arc.basename() not in known:
+                self._add(arc, catalogs)
+
+    def _add(self, arc, catalogs):
+        logging.info('Indexing files of {}'.format(arc.path()))
+        source = catalogs.reference(arc) if catalogs else arc.basepath()
+        with self._db:  # only committed once complete
+            archive_id = self._db.execute(
+                'INSERT INTO archives (basename) VALUES (?)',
+                (arc.basename(),)).lastrowid
+            self._db.executemany(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?)',
+                ((archive_id, path, status) for path, status in _list(source)))
+
+    def locate(self, chain, path):
+        # Given a chain of archives, newest first, each relative to the next,
+        # returns a dict mapping each file at or beneath 'path' that existed
+        # at the time of the first one to the archive that saved its data.
+        ids = dict(self._db.execute('SELECT basename, id FROM archives'))
+        sources = { }
+        pending = None
+        for arc in chain:
+            entries = self._entries(ids[arc.basename()], path)
+            if pending is None:
+                pending = set(file_path for file_path, status in entries
+                              if status != REMOVED)
+            for file_path, status in entries:
+                if status == SAVED and file_path in pending:
+                    sources[file_path] = arc
+                    pending.remove(file_path)
+            if not pending:
+                break
+        if pending:
+            logging.warning('No archive holds the data of {} files, such as '
+                            '"{}"'.format(len(pending), min(pending)))
+        return sources
+
+    def _entries(self, archive_id, path):
+        if not path:
+            return self._db.execute(
+                'SELECT path, status FROM files WHERE archive = ?',
+                (archive_id,)).fetchall()
+        # '0' is the character after '/'
+        return self._db.execute(
+            'SELECT path, status FROM files WHERE archive = ? AND '
+            '(path = ? OR (path > ? AND path < ?))',
+            (archive_id, path, path + '/', path + '0')).fetchall()
+
+def _list(basepath):
+    # Yields the path and status of each entry (other than directories) of the
+    # archive or isolated catalog at 'basepath', from dar's XML listing.
+    proc = subprocess.Popen(
+        [ '/usr/bin/dar', '-l', basepath, '-T', 'xml', '-Q' ],
+        stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+    try:
+        dirs = [ ]
+        for event, elem in ElementTree.iterparse(proc.stdout,
+                                                 ('start', 'end')):
+            if elem.tag == 'Directory':
+                if event == 'start':
+                    dirs.append(elem.get('name'))
+                else:
+                    dirs.pop()
+                    elem.clear()
+            elif (event == 'end' and elem.tag != 'Attributes' and
+                    elem.get('name') is not None):
+                if elem.tag == 'Deleted':
+                    status = REMOVED
+                else:
+                    attrs = elem.find('Attributes')
+                    status = (SAVED if attrs is not None and
+                              attrs.get('data') == 'saved' else UNCHANGED)
+                yield '/'.join(dirs + [ elem.get('name') ]), status
+                elem.clear()
+    except ElementTree.ParseError as e:
+        proc.kill()
+        raise BackupError('Cannot parse listing of {}: {}'.format(
+            basepath, exc_str(e)))
+    finally:
+        proc.stdout.close()
+        status = proc.wait()
+    if status != 0:
+        raise BackupError('dar exited with status {} listing {}'.format(
+            status, basepath))
@@ -0,0 +1,192 @@
+# Copyright 2013 Carlo Teubner
+#
+# This file is part of darbup.
+#
+# darbup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# darbup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with darbup.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, fcntl, mmap, threading, time, logging
+
+# The fcntl module only defines these from Python 3.10 on.
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+F_GETPIPE_SZ = getattr(fcntl, 'F_GETPIPE_SZ', 1032)
+
+def set_pipe_size(fd, size):
+    # Sets the capacity of the pipe 'fd' to (at least) 'size' bytes, if
+    # possible.  Returns the actual capacity.
+    if size:
+        try:
+            fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+        except OSError as e:
+            logging.warning('Failed to set pipe size to {} bytes: {}'.format(
+                size, e.strerror))
+    return fcntl.fcntl(fd, F_GETPIPE_SZ)
+
+class RingBuffer:
+    # Decouples the producer of the data in pipe 'src' from its consumer: one
+    # thread reads the data into an in-memory ring buffer of 'size' bytes as
+    # fast as it arrives, and another writes it from there to a new pipe,
+    # whose read end is 'fd'.  So the producer can carry on for as long as
+    # the buffer has room, while writing to the destination stalls.
+
+    def __init__(self, src, size, pipe_size=0):
+        self._src = src
+        self._size = size
+        self._mmap = mmap.mmap(-1, size)
+        if hasattr(mmap, 'MADV_HUGEPAGE'):
+            try:
+                self._mmap.madvise(mmap.MADV_HUGEPAGE)
+            except OSError:
+                pass
+        self._buffer = memoryview(self._mmap)
+        self.fd, self._write_fd = os.pipe()
+        set_pipe_size(self._write_fd, pipe_size)
+        self._cond = threading.Condition()
+        self._used = 0
+        self._read_pos = 0
+        self._write_pos = 0
+        self._eof = False
+        self._closing = False
+        self._error = None
+        # statistics
+        self._max_used = 0
+        self._used_integral = 0.0
+        self._last_change = None
+        self._start_time = None
+        self._producer_stall = 0.0
+        self._consumer_stall = 0.0
+        self._threads = [
+            threading.Thread(target=self._fill, name='ring buffer reader'),
+            threading.Thread(target=self._drain, name='ring buffer writer') ]
+        for thread in self._threads:
+            thread.daemon = True
+
+    def start(self):
+        self._start_time = self._last_change = time.monotonic()
+        for thread in self._threads:
+            thread.start()
+
+    def finish(self):
+        # To be called once all data has been read from 'fd'.  Raises the
+        # exception encountered by either thread, if any.
+        for thread in self._threads:
+            thread.join()
+        self._log_stats()
+        self._close_fds()
+        if self._error:
+            raise self._error
+
+    def close(self):
+        # Stops both threads, discarding any data not yet read from 'fd'.
+        # Must only be called once the producer has stopped writing to 'src'
+        # (else the reader thread may block indefinitely).
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        if self.fd is not None:
+            os.close(self.fd)  # make the writer thread fail with EPIPE
+            self.fd = None
+        for thread in self._threads:
+            if thread.ident is not None:
+                thread.join()
+        self._close_fds()
+
+    def _close_fds(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self._write_fd is not None:
+            os.close(self._write_fd)
+            self._write_fd = None
+        if self._buffer is not None:
+            self._buffer.release()
+            self._buffer = None
+            self._mmap.close()
+
+    def _fill(self):
+        try:
+            while True:
+                with self._cond:
+                    if self._used == self._size and not self._closing:
+                        start = time.monotonic()
+                        while self._used == self._size and not self._closing:
+                            self._cond.wait()
+                        self._producer_stall += time.monotonic() - start
+                    if self._closing:
+                        return
+                    pos = self._write_pos
+                    length = min(self._size - self._used, self._size - pos)
+                num_read = os.readv(self._src,
+                                    [ self._buffer[pos:pos+length] ])
+                with self._cond:
+                    if num_read == 0:
+                        self._eof = True
+                        self._cond.notify_all()
+                        return
+                    self._account()
+                    self._used += num_read
+                    self._max_used = max(self._max_used, self._used)
+                    self._write_pos = (pos + num_read) % self._size
+                    self._cond.notify_all()
+        except OSError as e:
+            with self._cond:
+                self._error = e
+                self._eof = True
+                self._cond.notify_all()
+
+    def _drain(self):
+        try:
+            while True:
+                with self._cond:
+                    if self._used == 0 and not (self._eof or self._closing):
+                        start = time.monotonic()
+                        while self._used == 0 and not (self._eof or
+                                                       self._closing):
+                            self._cond.wait()
+                        self._consumer_stall += time.monotonic() - start
+                    if self._closing or self._used == 0:
+                        return
+                    pos = self._read_pos
+                    length = min(self._used, self._size - pos)
+                num_written = os.write(self._write_fd,
+                                       self._buffer[pos:pos+length])
+                with self._cond:
+                    self._account()
+                    self._used -= num_written
+                    self._read_pos = (pos + num_written) % self._size
+                    self._cond.notify_all()
+        except OSError as e:
+            with self._cond:
+                if not self._closing:
+                    self._error = e
+                self._closing = True
+                self._cond.notify_all()
+        finally:
+            # signal EOF to whoever reads from 'fd'
+            with self._cond:
+                os.close(self._write_fd)
+                self._write_fd = None
+
+    def _account(self):
+        now = time.monotonic()
+        self._used_integral += self._used * (now - self._last_change)
+        self._last_change = now
+
+    def _log_stats(self):
+        secs = max(time.monotonic() - self._start_time, 1e-6)
+        logging.info('Ring buffer of {} bytes: max occupancy {}%, mean {}%; '
+                     'reading stalled for {:.1f}s (buffer full), writing '
+                     'for {:.1f}s (buffer empty), out of {:.1f}s'.format(
+                         self._size, self._max_used * 100 // self._size,
+                         int(self._used_integral * 100 / self._size / secs),
+                         self._producer_stall, self._consumer_stall, secs))
@@ -17,13 +17,31 @@
 
 from errors import BackupError
 
-class OldestPolicy:
+import heapq
+
+class RemovalPolicy:
+    def plan(self, arcset, now, nbytes):
+        # Returns the archives that successive calls to this policy would
+        # choose for removal, in order, until at least 'nbytes' bytes would be
+        # freed, or no more archives can be removed.  The set is not modified.
+        victims = [ ]
+        freed = 0
+        snapshot = arcset.snapshot()
+        while freed < nbytes:
+            arc = self(snapshot, now)
+            if not arc: break
+            victims.append(arc.original)
+            freed += arc.size
+            snapshot.remove(arc)
+        return victims
+
+class OldestPolicy(RemovalPolicy):
     def __call__(self, arcset, now):
         for arc in arcset:
             if not (arc.is_current or arc.has_dependent()):
                 return arc
 
-class ThinningPolicy:
+class ThinningPolicy(RemovalPolicy):
     def __call__(self, arcset, now):
         best_arc = None
         best_score = float('inf')
@@ -31,14 +49,8 @@ class ThinningPolicy:
             if arc.is_current: continue
             if not arc.prev(): continue
             if arc.has_dependent(): continue
-            prev_time = arc.prev().timestamp
-            if arc.next():
-                next_time = arc.next().timestamp
-            else:
-                next_time = now
-            score = _to_secs(arc.timestamp - prev_time) * \
-                    _to_secs(next_time - arc.timestamp) / \
-                    _to_secs(now - arc.timestamp)
+            next_time = arc.next().timestamp if arc.next() else now
+            score = _score(arc.prev().timestamp, arc.timestamp, next_time, now)
             if score < best_score:
                 best_score = score
                 best_arc = arc
@@ -48,7 +60,74 @@ class ThinningPolicy:
                 return first
         return best_arc
 
-class NeverPolicy:
+    def plan(self, arcset, now, nbytes):
+        # Same result as RemovalPolicy.plan(), but instead of rescoring every
+        # archive for every victim, keeps the scores in a heap, and only
+        # rescores the neighbours of each victim.  Heap entries are keyed by
+        # position, which breaks ties in the same way as __call__() does;
+        # entries that have since been rescored are skipped.  Removing a
+        # victim also rescores its reference archive, which may have become
+        # removable.
+        arcs = list(arcset)
+        n = len(arcs)
+        index = { arc: i for i, arc in enumerate(arcs) }
+        prev = list(range(-1, n - 1))
+        next_ = [ i + 1 if i + 1 < n else -1 for i in range(n) ]
+        reference = [ index[arc.reference()] if arc.reference() else -1
+                      for arc in arcs ]
+        num_dependents = [ 0 ] * n
+        for r in reference:
+            if r != -1: num_dependents[r] += 1
+        removed = [ False ] * n
+        version = [ 0 ] * n
+        heap = [ ]
+
+        def has_dependent(i):
+            return num_dependents[i] > 0
+
+        def push(i):
+            version[i] += 1
+            if arcs[i].is_current or prev[i] == -1 or has_dependent(i):
+                return
+            next_time = arcs[next_[i]].timestamp if next_[i] != -1 else now
+            score = _score(arcs[prev[i]].timestamp, arcs[i].timestamp,
+                           next_time, now)
+            heapq.heappush(heap, (score, i, version[i]))
+
+        for i in range(n):
+            push(i)
+
+        first = 0 if n else -1
+        victims = [ ]
+        freed = 0
+        while freed < nbytes:
+            victim = -1
+            while heap:
+                score, i, ver = heapq.heappop(heap)
+                if not removed[i] and ver == version[i]:
+                    victim = i
+                    break
+            if victim == -1:
+                if first == -1 or has_dependent(first) or \
+                        arcs[first].is_current:
+                    break
+                victim = first
+            victims.append(arcs[victim])
+            freed += arcs[victim].size
+            removed[victim] = True
+            p, q = prev[victim], next_[victim]
+            if p != -1: next_[p] = q
+            else: first = q
+            if q != -1: prev[q] = p
+            r = reference[victim]
+            if r != -1:
+                num_dependents[r] -= 1
+                if r != p: push(r)
+            if p != -1: push(p)
+            if q != -1: push(q)
+        return victims
+
+class NeverPolicy(RemovalPolicy):
     def __call__(self, arcset, now):
         # Don't just return None, because that causes the cleaner to throw a
         # NoRemovalCandidatesError, which may result in a retry after deleting
@@ -66,6 +145,10 @@ def rmpolicy_by_name(name):
     pol.name = name
     return pol
 
+def _score(prev_time, time, next_time, now):
+    return _to_secs(time - prev_time) * _to_secs(next_time - time) / \
+            _to_secs(now - time)
+
 def _to_secs(tdelta):
     return tdelta.days * 86400 + tdelta.seconds + \
             (1 if tdelta.microseconds >= 500000 else 0)
@@ -17,20 +17,61 @@
 
 from errors import BackupError
 
-class Schedules:
-    @staticmethod
-    def monthly(prev, now):
+import datetime
+
+# Each schedule is called as schedule(prev, now) to find out whether a backup
+# is due at 'now', given that the latest one was made at 'prev'; and
+# schedule.next_due(prev) returns the earliest time at which that is the case.
+
+class Monthly:
+    def __call__(self, prev, now):
         return prev.month != now.month or prev.year != now.year
 
-    @staticmethod
-    def daily(prev, now):
+    def next_due(self, prev):
+        if prev.month == 12:
+            return datetime.datetime(prev.year + 1, 1, 1)
+        return datetime.datetime(prev.year, prev.month + 1, 1)
+
+class Weekly:
+    # Weeks start on Monday.
+    def __call__(self, prev, now):
+        return prev.isocalendar()[:2] != now.isocalendar()[:2]
+
+    def next_due(self, prev):
+        return datetime.datetime.combine(
+            prev.date() + datetime.timedelta(days=7 - prev.weekday()),
+            datetime.time())
+
+class Daily:
+    def __call__(self, prev, now):
         return prev.day != now.day or prev.month != now.month \
                 or prev.year != now.year
 
-    @staticmethod
-    def always(prev, now):
+    def next_due(self, prev):
+        return datetime.datetime.combine(
+            prev.date() + datetime.timedelta(days=1), datetime.time())
+
+class Always:
+    def __call__(self, prev, now):
         return True
 
+    def next_due(self, prev):
+        return prev
+
+class Never:
+    def __call__(self, prev, now):
+        return False
+
+    def next_due(self, prev):
+        return datetime.datetime.max
+
+class Schedules:
+    monthly = Monthly()
+    weekly = Weekly()
+    daily = Daily()
+    always = Always()
+    never = Never()
+
 def schedule_by_name(name):
     sched = getattr(Schedules, name, None)
     if sched: return sched
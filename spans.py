@@ -0,0 +1,120 @@
+# Copyright 2013 Carlo Teubner
+#
+# This file is part of darbup.
+#
+# darbup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# darbup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with darbup.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading, time
+from collections import OrderedDict
+
+# Timing of the phases of a run, for --trace.  Phases are marked with
+#
+#   with spans.span('name'):
+#       ...
+#
+# and nest.  Time spent in spans of the same name within the same enclosing
+# span is added up.  Unless tracing has been enabled, span() returns a shared
+# object that does nothing, so marking phases costs next to nothing.
+
+class _Node:
+    def __init__(self, name):
+        self.name = name
+        self.secs = 0.0
+        self.count = 0
+        self.children = OrderedDict()
+
+class _Span:
+    def __init__(self, tracer, name):
+        self._tracer = tracer
+        self._name = name
+
+    def __enter__(self):
+        stack = self._tracer.stack()
+        parent = stack[-1]
+        node = parent.children.get(self._name)
+        if node is None:
+            node = parent.children[self._name] = _Node(self._name)
+        stack.append(node)
+        self._start = time.monotonic()
+
+    def __exit__(self, *exc_info):
+        secs = time.monotonic() - self._start
+        node = self._tracer.stack().pop()
+        node.secs += secs
+        node.count += 1
+
+class _NoSpan:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+class _Tracer:
+    # Each thread has its own tree of spans.
+    def __init__(self):
+        self._start = time.monotonic()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._roots = [ ]
+
+    def stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            root = _Node(threading.current_thread().name)
+            with self._lock:
+                self._roots.append(root)
+            stack = self._local.stack = [ root ]
+        return stack
+
+    def report(self, f, title):
+        main = self.stack()[0]
+        main.secs = time.monotonic() - self._start
+        main.count = 1
+        f.write('{}:\n'.format(title))
+        with self._lock:
+            roots = list(self._roots)
+        for root in roots:
+            _write_node(f, root, 1)
+
+def _write_node(f, node, depth):
+    label = '  ' * depth + node.name
+    if node.count > 1:
+        label += ' ({}x)'.format(node.count)
+    if node.secs or not node.children:
+        f.write('{:<60} {:10.3f}s\n'.format(label, node.secs))
+    else:
+        f.write(label + '\n')  # a thread's root: not timed as a whole
+    for child in node.children.values():
+        _write_node(f, child, depth + 1)
+
+_NO_SPAN = _NoSpan()
+_tracer = None
+
+def enable():
+    global _tracer
+    _tracer = _Tracer()
+
+def enabled():
+    return _tracer is not None
+
+def span(name):
+    if _tracer is None:
+        return _NO_SPAN
+    return _Span(_tracer, name)
+
+def report(f, title='Trace'):
+    # Writes the tree of spans recorded so far to file 'f'.
+    if _tracer is not None:
+        _tracer.report(f, title)
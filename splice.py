@@ -15,27 +15,17 @@
 # You should have received a copy of the GNU General Public License
 # along with darbup.  If not, see <http://www.gnu.org/licenses/>.
 
-import ctypes, ctypes.util
-from ctypes import c_int, c_size_t, c_ssize_t
-import os, errno
-
-def make_splice():
-    libc_name = ctypes.util.find_library('c')
-    libc = ctypes.CDLL(libc_name, use_errno=True)
-    c_splice = libc.splice
-    c_splice.restype = c_ssize_t
+import os
+import libc
 
+if hasattr(os, 'splice'):  # Python >= 3.10
+    splice = os.splice
+else:
     def splice(fd_in, fd_out, length):
-        while True:
-            res = c_splice(c_int(fd_in), None, c_int(fd_out), None,
-                           c_size_t(length), 0)
-            if res == -1:
-                errno_ = ctypes.get_errno()
-                if errno_ == errno.EINTR:
-                    continue
-                raise OSError(errno_, os.strerror(errno_))
-            return res
-    return splice
+        from ctypes import c_int, c_size_t
+        return libc.call('splice', c_int(fd_in), None, c_int(fd_out), None,
+                         c_size_t(length), 0)
 
-splice = make_splice()
-del make_splice
+def tee(fd_in, fd_out, length):
+    from ctypes import c_int, c_size_t
+    return libc.call('tee', c_int(fd_in), c_int(fd_out), c_size_t(length), 0)
@@ -0,0 +1,94 @@
+# Copyright 2013 Carlo Teubner
+#
+# This file is part of darbup.
+#
+# darbup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# darbup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with darbup.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, os.path, json, logging
+from datetime import datetime
+
+from errors import exc_str
+
+_TIME_FORMAT = '%Y-%m-%d %H:%M'
+
+# Local record of what a section's destination directory contains, so that we
+# can tell that no backup is due without touching the (possibly sleeping) disk
+# the destination directory is on.
+
+class SectionState:
+    def __init__(self, cfg):
+        self._dest_dir = cfg.dest_dir
+        self._path = os.path.join(cfg.state_dir,
+                                  cfg.name.replace('/', '_') + '.state')
+        self._data = self._read()
+
+    def latest_time(self):
+        # Returns the timestamp of the latest archive, or None if unknown (or
+        # if there are no archives).
+        latest = self._data.get('latest')
+        if latest:
+            return datetime.strptime(latest, _TIME_FORMAT)
+        return None
+
+    def consolidation_time(self):
+        # Returns the time of the latest consolidation attempt, if any.
+        consolidated = self._data.get('consolidated')
+        if consolidated:
+            return datetime.strptime(consolidated, _TIME_FORMAT)
+        return None
+
+    def record_consolidation(self, now):
+        data = dict(self._data, dest_dir=self._dest_dir,
+                    consolidated=now.strftime(_TIME_FORMAT))
+        self._write(data)
+
+    def record(self, arcset):
+        latest = None
+        for arc in arcset:
+            if not arc.is_current:
+                latest = arc
+        data = { 'dest_dir': self._dest_dir }
+        if 'consolidated' in self._data:
+            data['consolidated'] = self._data['consolidated']
+        if latest:
+            data['latest'] = latest.timestamp.strftime(_TIME_FORMAT)
+            data['type'] = latest.kind
+        if data != self._data:
+            self._write(data)
+
+    def _read(self):
+        try:
+            with open(self._path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return { }
+        except (OSError, ValueError) as e:
+            logging.warning('Ignoring unreadable state file {}: {}'.format(
+                self._path, exc_str(e)))
+            return { }
+        if data.get('dest_dir') != self._dest_dir:
+            return { }
+        return data
+
+    def _write(self, data):
+        temp_path = self._path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            with open(temp_path, 'w') as f:
+                json.dump(data, f, sort_keys=True)
+            os.replace(temp_path, self._path)
+            self._data = data
+        except OSError as e:
+            logging.warning('Failed to write state file {}: {}'.format(
+                self._path, exc_str(e)))
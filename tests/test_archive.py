@@ -0,0 +1,67 @@
+# Copyright 2013 Carlo Teubner
+#
+# This file is part of darbup.
+#
+# darbup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# darbup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with darbup.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime, importlib.util, os, os.path, sys, tempfile, unittest
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT)
+
+from arcindex import ArchiveIndex
+
+_spec = importlib.util.spec_from_file_location(
+    'darbup_main', os.path.join(_ROOT, '__main__.py'))
+darbup = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(darbup)
+
+class PartialFileTest(unittest.TestCase):
+    # A partial archive must not survive an interrupted run, even if archives
+    # were removed (updating the index) while it was being written.
+
+    OLD = 'x-2013-07-01-0000-full.1.dar'
+    FULL = 'x-2013-08-01-0000-full.1.dar'
+    NEW = 'x-2013-08-02-0000-incr.1.dar'
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.dir = self._tmp.name
+        for basename in (self.OLD, self.FULL):
+            with open(os.path.join(self.dir, basename), 'wb') as f:
+                f.write(b'\0' * 100)
+        self.arcset = darbup.open_arcset('x', self.dir)
+        self.arcset.append_current(datetime.datetime(2013, 8, 2), 'incr')
+        self.temp_path = self.arcset.create_current_temp()
+        self.arcset.delete(self.arcset.find(self.OLD))
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_interrupted(self):
+        self.assertFalse(ArchiveIndex(self.dir).is_fresh())
+        arcset = darbup.open_arcset('x', self.dir)
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         [ '.darbup-index', self.FULL ])
+        self.assertEqual([ arc.basename() for arc in arcset ], [ self.FULL ])
+
+    def test_committed(self):
+        self.arcset.commit_current(self.temp_path)
+        self.assertTrue(ArchiveIndex(self.dir).is_fresh())
+        arcset = darbup.open_arcset('x', self.dir)
+        self.assertEqual([ arc.basename() for arc in arcset ],
+                         [ self.FULL, self.NEW ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+# Copyright 2013 Carlo Teubner
+#
+# This file is part of darbup.
+#
+# darbup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# darbup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with darbup.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime, importlib.util, os, os.path, sys, tempfile, unittest
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT)
+
+import config, procwrite
+
+_spec = importlib.util.spec_from_file_location(
+    'darbup_main', os.path.join(_ROOT, '__main__.py'))
+darbup = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(darbup)
+
+K = 1024
+
+class MirrorRetryTest(unittest.TestCase):
+    # A primary destination and a mirror, one of which runs out of space
+    # while the other has room to spare.
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.dirs = { n: os.path.join(self._tmp.name, n)
+                      for n in ('primary', 'mirror', 'state', 'lock') }
+        for d in self.dirs.values():
+            os.mkdir(d)
+        conf = os.path.join(self._tmp.name, 'darbup.conf')
+        with open(conf, 'w') as f:
+            f.write('[Backup test]\n'
+                    'DestinationDir = {primary}\n'
+                    'MirrorDirs = {mirror}\n'
+                    'DarArguments = -R /\n'
+                    'Capacity = 1M\n'
+                    'PreCleaning = no\n'
+                    'CatalogCache = no\n'.format(**self.dirs))
+        self.cfg = config.Config(conf, self.dirs['state'],
+                                 self.dirs['lock']).instances[0]
+        self.commands = [ ]
+        self._proc_write = procwrite.proc_write
+        procwrite.proc_write = self.fake_proc_write
+
+    def tearDown(self):
+        procwrite.proc_write = self._proc_write
+        self._tmp.cleanup()
+
+    def fake_proc_write(self, command, outputs, *args):
+        # Instead of dar, write 100K of zeros.
+        self.commands.append(command)
+        return self._proc_write([ 'head', '-c', str(100 * K), '/dev/zero' ],
+                                outputs, *args)
+
+    def make_archive(self, dest, basename, size):
+        with open(os.path.join(self.dirs[dest], basename), 'wb') as f:
+            f.write(b'\0' * size)
+
+    def archives(self, dest):
+        return sorted(fn for fn in os.listdir(self.dirs[dest])
+                      if fn.endswith('.dar'))
+
+    def test_mirror_runs_out(self):
+        full = 'test-2013-08-01-0000-full.1.dar'
+        incr = 'test-2013-08-02-0000-incr.1.dar'
+        new = 'test-2013-08-03-0000-incr.1.dar'
+        self.make_archive('primary', full, 10 * K)
+        self.make_archive('primary', incr, 10 * K)
+        self.make_archive('mirror', full, 10 * K)
+        self.make_archive('mirror', incr, 1000 * K)
+        arcsets = [ darbup.open_arcset('test', self.dirs[d])
+                    for d in ('primary', 'mirror') ]
+        darbup.backup('incr', self.cfg, datetime.datetime(2013, 8, 3),
+                      arcsets)
+        # Only writing to the mirror fails: dar is not restarted, and the
+        # primary destination is left alone.
+        self.assertEqual(len(self.commands), 1)
+        self.assertEqual(self.commands[0][3:5],
+                         [ '-A', os.path.join(self.dirs['primary'],
+                                              incr[:-6]) ])
+        self.assertEqual(self.archives('primary'), [ full, incr, new ])
+        self.assertEqual(self.archives('mirror'), [ full, incr ])
+        self.assertEqual(os.listdir(self.dirs['mirror']).count(new + '.part'),
+                         0)
+
+    def test_primary_runs_out(self):
+        # The primary destination removes the archive that dar's output was to
+        # be relative to, so the mirror, which still has it, must be skipped.
+        full = 'test-2013-08-01-0000-full.1.dar'
+        incr = 'test-2013-08-02-0000-incr.1.dar'
+        new = 'test-2013-08-03-0000-incr.1.dar'
+        self.make_archive('primary', full, 10 * K)
+        self.make_archive('primary', incr, 1000 * K)
+        self.make_archive('mirror', full, 10 * K)
+        self.make_archive('mirror', incr, 10 * K)
+        arcsets = [ darbup.open_arcset('test', self.dirs[d])
+                    for d in ('primary', 'mirror') ]
+        darbup.backup('incr', self.cfg, datetime.datetime(2013, 8, 3),
+                      arcsets)
+        self.assertEqual(self.commands[-1][3:5],
+                         [ '-A', os.path.join(self.dirs['primary'],
+                                              full[:-6]) ])
+        self.assertEqual(self.archives('primary'), [ full, new ])
+        self.assertEqual(self.archives('mirror'), [ full, incr ])
+
+if __name__ == '__main__':
+    unittest.main()
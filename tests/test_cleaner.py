@@ -0,0 +1,116 @@
+# Copyright 2013 Carlo Teubner
+#
+# This file is part of darbup.
+#
+# darbup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# darbup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with darbup.  If not, see <http://www.gnu.org/licenses/>.
+
+import os.path, sys, threading, unittest
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cleaner import BackgroundCleaner
+from errors import BackupError, NoRemovalCandidatesError
+
+class FakeArchive:
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+    def path(self):
+        return self.name
+
+    def basename(self):
+        return self.name
+
+class FakeArchiveSet:
+    # Deleting an archive waits for 'gate' to be set, then sets 'deleted'.
+
+    def __init__(self, *sizes):
+        self.archives = [ FakeArchive('a{}'.format(i), size)
+                          for i, size in enumerate(sizes) ]
+        self.gate = threading.Event()
+        self.gate.set()
+        self.deleted = threading.Event()
+
+    def delete(self, arc):
+        self.gate.wait()
+        self.archives.remove(arc)
+        self.deleted.set()
+
+    def __str__(self):
+        return ', '.join(arc.name for arc in self.archives)
+
+class FakePolicy:
+    # Chooses the oldest archive, or raises 'error' if set.
+
+    name = 'fake'
+
+    def __init__(self):
+        self.error = None
+
+    def __call__(self, arcset, now):
+        if self.error:
+            raise self.error
+        return arcset.archives[0] if arcset.archives else None
+
+class BackgroundCleanerTest(unittest.TestCase):
+    def setUp(self):
+        self.policy = FakePolicy()
+        self.arcset = FakeArchiveSet(300, 400)
+        self.cleaner = BackgroundCleaner(self.policy, self.arcset,
+                                         datetime(2020, 1, 1), None, 100)
+
+    def tearDown(self):
+        self.cleaner.close()
+
+    def test_watermark(self):
+        self.assertEqual(self.cleaner.progress(1000), 0)
+        self.assertEqual(self.cleaner.progress(500), 0)
+        self.assertFalse(self.arcset.deleted.is_set())
+        self.cleaner.progress(50)
+        self.assertTrue(self.arcset.deleted.wait(5))
+        self.assertEqual(self.cleaner.progress(50), 300)
+        self.assertEqual(self.cleaner.removed, [ ('a0', 300) ])
+        self.assertEqual(self.cleaner.progress(350), 0)
+
+    def test_writer_blocks(self):
+        self.cleaner.progress(1000)
+        self.arcset.gate.clear()
+        result = [ ]
+        writer = threading.Thread(target=lambda:
+                                  result.append(self.cleaner()))
+        writer.start()
+        writer.join(0.2)
+        self.assertTrue(writer.is_alive())
+        self.arcset.gate.set()
+        writer.join(5)
+        self.assertFalse(writer.is_alive())
+        self.assertEqual(result, [ 300 ])
+
+    def test_error(self):
+        self.cleaner.progress(1000)
+        self.policy.error = BackupError('policy failed')
+        with self.assertRaisesRegex(BackupError, 'policy failed'):
+            self.cleaner()
+        self.assertEqual(len(self.arcset.archives), 2)
+
+    def test_no_candidates(self):
+        self.arcset.archives = [ ]
+        self.cleaner.progress(1000)
+        with self.assertRaises(NoRemovalCandidatesError):
+            self.cleaner()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+# Copyright 2013 Carlo Teubner
+#
+# This file is part of darbup.
+#
+# darbup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# darbup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with darbup.  If not, see <http://www.gnu.org/licenses/>.
+
+import os.path, random, sys, tempfile, unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from archive import Archive, ArchiveSet, KINDS
+from rmpolicies import RemovalPolicy, rmpolicy_by_name
+
+class ThinningPlanTest(unittest.TestCase):
+    # ThinningPolicy.plan() must choose the same archives, in the same order,
+    # as calling the policy repeatedly (which is what RemovalPolicy.plan()
+    # does).
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.policy = rmpolicy_by_name('thinning')
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def random_set(self, rng):
+        # Returns a set of up to 60 archives of random kinds, sizes and
+        # spacing, half the time with a current archive, and a time after
+        # them all.
+        arcset = ArchiveSet('x', self._tmp.name)
+        t = datetime(2020, 1, 1)
+        for i in range(rng.randint(0, 60)):
+            t += timedelta(minutes=rng.choice(
+                [ 60, 1440, 1440, 30 * 1440, rng.randint(1, 10000) ]))
+            kind = 'full' if i == 0 else rng.choice(('incr', 'incr', 'diff',
+                                                     'full'))
+            basename = arcset.basename_for(t, kind)
+            arcset._append(Archive(self._tmp.name, basename, t, kind,
+                                   rng.randint(1, 1000)))
+        if len(arcset) and rng.random() < 0.5:
+            t += timedelta(minutes=5)
+            arcset.append_current(t, rng.choice(KINDS))
+        return arcset, t + timedelta(minutes=rng.randint(1, 5000))
+
+    def test_plan_matches_greedy(self):
+        rng = random.Random(1)
+        for trial in range(2000):
+            arcset, now = self.random_set(rng)
+            nbytes = rng.choice((0, 1, rng.randint(1, 40000), 10**9))
+            fast = self.policy.plan(arcset, now, nbytes)
+            slow = RemovalPolicy.plan(self.policy, arcset, now, nbytes)
+            self.assertEqual([ arc.basename() for arc in fast ],
+                             [ arc.basename() for arc in slow ],
+                             'trial {}'.format(trial))
+
+    def test_plan_keeps_references(self):
+        # No archive is removed while one that survives is relative to it.
+        rng = random.Random(7)
+        for trial in range(1000):
+            arcset, now = self.random_set(rng)
+            victims = set(self.policy.plan(arcset, now, 10**9))
+            for arc in arcset:
+                if arc not in victims and arc.reference():
+                    self.assertNotIn(arc.reference(), victims,
+                                     'trial {}'.format(trial))
+
+if __name__ == '__main__':
+    unittest.main()
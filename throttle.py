@@ -0,0 +1,106 @@
+# Copyright 2013 Carlo Teubner
+#
+# This file is part of darbup.
+#
+# darbup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# darbup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with darbup.  If not, see <http://www.gnu.org/licenses/>.
+
+import time, logging
+
+_BURST_SECS = 0.5  # how far the token bucket may run ahead
+_MIN_RATE = 1 << 20
+_PRESSURE_INTERVAL = 1.0
+_PRESSURE_FILES = ('/proc/pressure/io', '/proc/pressure/memory')
+
+class Throttle:
+    # Limits the rate at which data is written to 'rate' bytes per second
+    # (unless 0), using a token bucket.  If 'pressure_threshold' is nonzero,
+    # also backs off while the share of time that tasks on the system are
+    # stalled waiting for I/O or memory (as reported by the kernel's pressure
+    # stall information) exceeds that many percent: the rate is halved each
+    # second that this is the case, and raised again gradually once it no
+    # longer is.
+
+    def __init__(self, rate, pressure_threshold=0):
+        self._max_rate = rate or None
+        self._rate = self._max_rate
+        self._threshold = pressure_threshold / 100
+        self._tokens = 0
+        self._last = time.monotonic()
+        self._interval_start = self._last
+        self._interval_bytes = 0
+        self._pressure = self._read_pressure() if pressure_threshold else None
+        self.num_backoffs = 0
+        self.slept = 0.0
+
+    def __call__(self, nbytes):
+        # Called after writing 'nbytes' bytes; sleeps as needed.
+        now = time.monotonic()
+        self._interval_bytes += nbytes
+        if self._pressure is not None and (now - self._interval_start >=
+                                           _PRESSURE_INTERVAL):
+            self._adapt(now)
+        if self._rate is None:
+            return
+        self._tokens = min(self._tokens + (now - self._last) * self._rate,
+                           self._rate * _BURST_SECS) - nbytes
+        self._last = now
+        if self._tokens < 0:
+            secs = -self._tokens / self._rate
+            time.sleep(secs)
+            self.slept += secs
+            self._last += secs
+            self._tokens = 0
+
+    def _adapt(self, now):
+        secs = now - self._interval_start
+        throughput = self._interval_bytes / secs
+        pressure = self._read_pressure()
+        if pressure is None:
+            self._pressure = None
+            return
+        stalled = max((p - q) / 1e6 / secs
+                      for p, q in zip(pressure, self._pressure))
+        self._pressure = pressure
+        self._interval_start = now
+        self._interval_bytes = 0
+        if stalled > self._threshold:
+            rate = max((self._rate or throughput) / 2, _MIN_RATE)
+            if rate != self._rate:
+                logging.debug('System under pressure ({:.0f}% stalled); '
+                              'throttling to {:.1f} MiB/s'.format(
+                                  stalled * 100, rate / 2**20))
+                self.num_backoffs += 1
+            self._rate = rate
+        elif self._rate is not None and self._rate != self._max_rate:
+            self._rate *= 1.25
+            if self._max_rate is not None:
+                self._rate = min(self._rate, self._max_rate)
+            elif self._rate > 2 * throughput:
+                self._rate = None  # no longer what limits us
+                logging.debug('Pressure has subsided; no longer throttling')
+
+    def _read_pressure(self):
+        # Returns the total time in microseconds that some tasks were stalled,
+        # for each resource.
+        try:
+            totals = [ ]
+            for filename in _PRESSURE_FILES:
+                with open(filename) as f:
+                    line = f.readline()  # "some avg10=... total=..."
+                totals.append(int(line.rsplit('total=', 1)[1]))
+            return totals
+        except (OSError, IndexError, ValueError) as e:
+            logging.warning('Cannot read pressure stall information; not '
+                            'throttling on pressure: {}'.format(e))
+            return None